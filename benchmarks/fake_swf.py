@@ -0,0 +1,354 @@
+"""In-memory stand-in for a ``boto.swf`` connection.
+
+Implements the calls flowser makes to run workflows: starting executions,
+long polls for decision and activity tasks (with history paging), and
+responding to them. Decisions supported are ScheduleActivityTask,
+CompleteWorkflowExecution, FailWorkflowExecution, StartTimer, RecordMarker
+and StartChildWorkflowExecution; a decision task completed with any other
+decision is rejected, before any of its decisions are applied. Events are
+time stamped with ``time.time()``, so histories can be analyzed like real
+ones (see ``flowser.analysis``).
+
+``close`` makes pending and later polls raise ``Closed``, which ends the
+polling loops of deciders and workers.
+"""
+import copy
+import itertools
+import threading
+import time
+from collections import defaultdict, deque
+
+from boto.exception import SWFResponseError
+
+SUPPORTED_DECISIONS = (
+    'ScheduleActivityTask',
+    'CompleteWorkflowExecution',
+    'FailWorkflowExecution',
+    'RecordMarker',
+    'StartTimer',
+    'StartChildWorkflowExecution',
+)
+
+
+class Closed(Exception):
+    pass
+
+
+class _Execution(object):
+
+    def __init__(self, workflow_id, run_id, workflow_type, task_list):
+        self.workflow_id = workflow_id
+        self.run_id = run_id
+        self.workflow_type = workflow_type
+        self.task_list = task_list
+        self.events = []
+        self.previous_started = 0
+        # None, 'scheduled' or 'started'
+        self.decision = None
+        self.decision_scheduled = None
+        # Whether a decision task is due once the started one completes
+        self.decision_needed = False
+        self.closed = False
+        # (parent execution, initiated event id, started event id) of
+        # child executions
+        self.parent = None
+
+    @property
+    def info(self):
+        return {'workflowId': self.workflow_id, 'runId': self.run_id}
+
+
+class FakeSWF(object):
+
+    def __init__(self, poll_timeout=1.0, page_size=100):
+        """
+        :param poll_timeout: Seconds until a poll returns without a task.
+        :param page_size: Default number of history events per page.
+        """
+        self.poll_timeout = poll_timeout
+        self.page_size = page_size
+        self._cond = threading.Condition()
+        self._executions = {}
+        self._decision_tasks = defaultdict(deque)
+        self._activity_tasks = defaultdict(deque)
+        self._tokens = {}
+        self._ids = itertools.count(1)
+        self._timers = []
+        self._closed = False
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        for timer in self._timers:
+            timer.cancel()
+
+    # Starting
+
+    def start_workflow_execution(self, domain, workflow_id, workflow_name,
+                                 workflow_version, task_list=None,
+                                 input=None, **kwargs):
+        with self._cond:
+            if self._running(workflow_id):
+                raise SWFResponseError(400, 'Bad Request')
+            execution = self._start(workflow_id, {'name': workflow_name,
+                                                  'version': workflow_version},
+                                    task_list, input)
+        return {'runId': execution.run_id}
+
+    def _running(self, workflow_id):
+        existing = self._executions.get(workflow_id)
+        return existing is not None and not existing.closed
+
+    def _start(self, workflow_id, workflow_type, task_list, input):
+        execution = _Execution(workflow_id, 'run-%d' % next(self._ids),
+                               workflow_type, task_list)
+        self._executions[workflow_id] = execution
+        self._add(execution, 'WorkflowExecutionStarted',
+                  input=input, taskList={'name': task_list},
+                  workflowType=workflow_type)
+        self._schedule_decision(execution)
+        return execution
+
+    # Decision tasks
+
+    def poll_for_decision_task(self, domain, task_list, identity=None,
+                               maximum_page_size=None, next_page_token=None,
+                               reverse_order=None):
+        if next_page_token is not None:
+            token, offset = next_page_token.split(':')
+            execution, events, started = self._tokens[token][:3]
+            return self._decision_page(token, execution, events, started,
+                                       int(offset), maximum_page_size)
+        with self._cond:
+            execution = self._wait(self._decision_tasks[task_list])
+            if execution is None:
+                return {}
+            scheduled = execution.decision_scheduled
+            started = self._add(execution, 'DecisionTaskStarted',
+                                scheduledEventId=scheduled,
+                                identity=identity)
+            execution.decision = 'started'
+            events = list(execution.events)
+            if reverse_order:
+                events.reverse()
+            token = str(next(self._ids))
+            self._tokens[token] = (execution, events, started, scheduled)
+        return self._decision_page(token, execution, events, started, 0,
+                                   maximum_page_size)
+
+    def _decision_page(self, token, execution, events, started, offset,
+                       page_size):
+        page_size = page_size or self.page_size
+        result = {
+            'taskToken': token,
+            # Copies, like a fresh response; flowser unserializes in place.
+            'events': copy.deepcopy(events[offset:offset + page_size]),
+            'previousStartedEventId': execution.previous_started,
+            'startedEventId': started,
+            'workflowExecution': execution.info,
+            'workflowType': execution.workflow_type,
+        }
+        if offset + page_size < len(events):
+            result['nextPageToken'] = '%s:%d' % (token, offset + page_size)
+        return result
+
+    def respond_decision_task_completed(self, task_token, decisions=None,
+                                        execution_context=None):
+        for decision in decisions or []:
+            if decision['decisionType'] not in SUPPORTED_DECISIONS:
+                raise NotImplementedError(
+                        "FakeSWF does not model %s decisions (supported: %s)"
+                        % (decision['decisionType'],
+                           ', '.join(SUPPORTED_DECISIONS)))
+        with self._cond:
+            execution, _, started, scheduled = self._tokens.pop(task_token)
+            completed = self._add(execution, 'DecisionTaskCompleted',
+                                  scheduledEventId=scheduled,
+                                  startedEventId=started,
+                                  executionContext=execution_context)
+            execution.previous_started = started
+            execution.decision = None
+            for decision in decisions or []:
+                self._apply(execution, decision, completed)
+            if execution.decision_needed:
+                execution.decision_needed = False
+                self._schedule_decision(execution)
+
+    def respond_decision_task_failed(self, task_token, details=None,
+                                     reason=None):
+        with self._cond:
+            execution = self._tokens.pop(task_token)[0]
+            execution.decision = None
+            self._schedule_decision(execution)
+
+    def _apply(self, execution, decision, completed):
+        kind = decision['decisionType']
+        key = kind[0].lower() + kind[1:] + 'DecisionAttributes'
+        attrs = dict(decision.get(key, {}),
+                     decisionTaskCompletedEventId=completed)
+        if kind == 'ScheduleActivityTask':
+            scheduled = self._add(execution, 'ActivityTaskScheduled', **attrs)
+            self._activity_tasks[attrs['taskList']['name']].append(
+                    (execution, scheduled, attrs))
+            self._cond.notify_all()
+        elif kind == 'CompleteWorkflowExecution':
+            self._add(execution, 'WorkflowExecutionCompleted', **attrs)
+            self._close(execution, 'ChildWorkflowExecutionCompleted',
+                        result=attrs.get('result'))
+        elif kind == 'FailWorkflowExecution':
+            self._add(execution, 'WorkflowExecutionFailed', **attrs)
+            self._close(execution, 'ChildWorkflowExecutionFailed',
+                        reason=attrs.get('reason'),
+                        details=attrs.get('details'))
+        elif kind == 'RecordMarker':
+            self._add(execution, 'MarkerRecorded', **attrs)
+        elif kind == 'StartTimer':
+            started = self._add(execution, 'TimerStarted', **attrs)
+            timer = threading.Timer(float(attrs['startToFireTimeout']),
+                                    self._fire, (execution, attrs, started))
+            timer.daemon = True
+            timer.start()
+            self._timers.append(timer)
+        elif kind == 'StartChildWorkflowExecution':
+            self._start_child(execution, attrs)
+
+    def _start_child(self, parent, attrs):
+        workflow_id = attrs['workflowId']
+        if self._running(workflow_id):
+            self._add(parent, 'StartChildWorkflowExecutionFailed',
+                      workflowId=workflow_id,
+                      workflowType=attrs['workflowType'],
+                      cause='WORKFLOW_ALREADY_RUNNING',
+                      control=attrs.get('control'),
+                      decisionTaskCompletedEventId=attrs[
+                          'decisionTaskCompletedEventId'])
+            self._schedule_decision(parent)
+            return
+        initiated = self._add(parent, 'StartChildWorkflowExecutionInitiated',
+                              **attrs)
+        child = self._start(workflow_id, attrs['workflowType'],
+                            attrs['taskList']['name'], attrs.get('input'))
+        started = self._add(parent, 'ChildWorkflowExecutionStarted',
+                            workflowExecution=child.info,
+                            workflowType=child.workflow_type,
+                            initiatedEventId=initiated)
+        child.parent = (parent, initiated, started)
+        self._schedule_decision(parent)
+
+    def _close(self, execution, parent_event_type, **attrs):
+        """Close ``execution`` and tell its parent, if any. """
+        execution.closed = True
+        if execution.parent is None:
+            return
+        parent, initiated, started = execution.parent
+        self._add(parent, parent_event_type,
+                  workflowExecution=execution.info,
+                  workflowType=execution.workflow_type,
+                  initiatedEventId=initiated, startedEventId=started,
+                  **attrs)
+        self._schedule_decision(parent)
+
+    def _fire(self, execution, attrs, started):
+        with self._cond:
+            self._add(execution, 'TimerFired', timerId=attrs['timerId'],
+                      startedEventId=started)
+            self._schedule_decision(execution)
+
+    def _schedule_decision(self, execution):
+        if execution.closed:
+            return
+        if execution.decision == 'started':
+            execution.decision_needed = True
+        elif execution.decision is None:
+            execution.decision_scheduled = self._add(
+                    execution, 'DecisionTaskScheduled',
+                    taskList={'name': execution.task_list})
+            execution.decision = 'scheduled'
+            self._decision_tasks[execution.task_list].append(execution)
+            self._cond.notify_all()
+
+    # Activity tasks
+
+    def poll_for_activity_task(self, domain, task_list, identity=None):
+        with self._cond:
+            task = self._wait(self._activity_tasks[task_list])
+            if task is None:
+                return {}
+            execution, scheduled, attrs = task
+            started = self._add(execution, 'ActivityTaskStarted',
+                                scheduledEventId=scheduled,
+                                identity=identity)
+            token = str(next(self._ids))
+            self._tokens[token] = (execution, scheduled, started)
+        return {
+            'activityId': attrs['activityId'],
+            'activityType': attrs['activityType'],
+            'input': attrs.get('input'),
+            'startedEventId': started,
+            'taskToken': token,
+            'workflowExecution': execution.info,
+        }
+
+    def respond_activity_task_completed(self, task_token, result=None):
+        self._close_activity(task_token, 'ActivityTaskCompleted',
+                             result=result)
+
+    def respond_activity_task_failed(self, task_token, details=None,
+                                     reason=None):
+        self._close_activity(task_token, 'ActivityTaskFailed',
+                             details=details, reason=reason)
+
+    def respond_activity_task_canceled(self, task_token, details=None):
+        self._close_activity(task_token, 'ActivityTaskCanceled',
+                             details=details)
+
+    def _close_activity(self, task_token, event_type, **attrs):
+        with self._cond:
+            execution, scheduled, started = self._tokens.pop(task_token)
+            self._add(execution, event_type, scheduledEventId=scheduled,
+                      startedEventId=started, **attrs)
+            self._schedule_decision(execution)
+
+    # History
+
+    def get_workflow_execution_history(self, domain, run_id, workflow_id,
+                                       maximum_page_size=None,
+                                       next_page_token=None,
+                                       reverse_order=None):
+        with self._cond:
+            events = list(self._executions[workflow_id].events)
+        if reverse_order:
+            events.reverse()
+        page_size = maximum_page_size or self.page_size
+        offset = int(next_page_token or 0)
+        result = {'events': copy.deepcopy(events[offset:offset + page_size])}
+        if offset + page_size < len(events):
+            result['nextPageToken'] = str(offset + page_size)
+        return result
+
+    def _wait(self, queue):
+        """Pop from ``queue``, waiting up to ``poll_timeout``. Must be called
+        with the lock held. """
+        deadline = time.time() + self.poll_timeout
+        while not queue:
+            if self._closed:
+                raise Closed()
+            left = deadline - time.time()
+            if left <= 0:
+                return None
+            self._cond.wait(left)
+        if self._closed:
+            raise Closed()
+        return queue.popleft()
+
+    def _add(self, execution, event_type, **attrs):
+        event_id = len(execution.events) + 1
+        key = event_type[0].lower() + event_type[1:] + 'EventAttributes'
+        execution.events.append({
+            'eventId': event_id,
+            'eventTimestamp': time.time(),
+            'eventType': event_type,
+            key: dict((k, v) for k, v in attrs.items() if v is not None),
+        })
+        return event_id
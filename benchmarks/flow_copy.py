@@ -0,0 +1,49 @@
+"""Flow.copy benchmark.
+
+Compares ``Flow.copy`` with the JSON round-trip it replaced on flows of
+increasing size.
+
+    $ python benchmarks/flow_copy.py [-n RUNS]
+"""
+import argparse
+import os
+import sys
+import timeit
+from json import dumps, loads
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flowser.flow import Flow, Node, ActivityNode, freeze, unfreeze
+
+
+def build_flow(width):
+    flow = Flow(props={'width': width})
+    root = Node(flow)
+    sink = Node(flow)
+    for n in range(width):
+        node = ActivityNode(flow, activity_type='app.Activity')
+        node.ctx['_done'] = {'%s-0' % node.id: [[n] * 10, None]}
+        node.result = [[n] * 10]
+        root.connect(node).connect(sink)
+    return flow
+
+
+def json_copy(flow):
+    return unfreeze(loads(dumps(freeze(flow))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--runs', type=int, default=5)
+    args = parser.parse_args()
+    for width in (100, 1000, 10000):
+        flow = build_flow(width)
+        old = min(timeit.repeat(lambda: json_copy(flow), number=1,
+                                repeat=args.runs))
+        new = min(timeit.repeat(flow.copy, number=1, repeat=args.runs))
+        print('%6d nodes  json %8.2f ms  copy %8.2f ms  (%.1fx)' % (
+                width, old * 1000, new * 1000, old / new))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,242 @@
+"""Micro-benchmarks of flowser hot paths.
+
+Runs offline, without a connection. Each benchmark builds its input, which
+is not timed, then times one call; the best and median of ``--runs`` runs
+are reported per operation. Results can be saved as JSON and compared with
+an earlier run:
+
+    $ python benchmarks/hot_paths.py -o before.json
+    $ python benchmarks/hot_paths.py -c before.json [-k REGEX]
+"""
+import argparse
+import json
+import os
+import platform
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flowser import serializing
+from flowser.domain import Domain
+from flowser.events import Event
+from flowser.flow import Flow, Node, ActivityNode, freeze, unfreeze
+from flowser.tasks import Decision
+from flowser.types import Activity, Workflow
+
+_benchmarks = []
+
+
+def benchmark(name, ops=1, **params):
+    """Register a function returning the callable to time. ``ops`` is the
+    number of operations one call performs. """
+    def decorator(setup):
+        _benchmarks.append((name, params, ops, setup))
+        return setup
+    return decorator
+
+
+class BenchActivity(Activity):
+    name = 'BenchActivity'
+    version = '1.0'
+    task_list = 'bench'
+
+
+class BenchWorkflow(Workflow):
+    name = 'BenchWorkflow'
+    version = '1.0'
+    task_list = 'bench'
+
+
+class BenchDomain(Domain):
+    name = 'bench'
+    workflow_types = [BenchWorkflow]
+    activity_types = [BenchActivity]
+
+
+def raw_history(size):
+    """History of ``size`` events, most recent first. """
+    activity_type = {'name': 'BenchActivity', 'version': '1.0'}
+    events = [{
+        'eventId': 1, 'eventTimestamp': 0.0,
+        'eventType': 'WorkflowExecutionStarted',
+        'workflowExecutionStartedEventAttributes': {'input': '{}'},
+    }]
+    while len(events) < size:
+        n = len(events) + 1
+        events.append({
+            'eventId': n, 'eventTimestamp': float(n),
+            'eventType': 'ActivityTaskScheduled',
+            'activityTaskScheduledEventAttributes': {
+                'activityId': str(n), 'activityType': activity_type,
+                'input': '[1, 2, 3]', 'taskList': {'name': 'bench'}},
+        })
+        events.append({
+            'eventId': n + 1, 'eventTimestamp': float(n + 1),
+            'eventType': 'ActivityTaskStarted',
+            'activityTaskStartedEventAttributes': {'scheduledEventId': n},
+        })
+        events.append({
+            'eventId': n + 2, 'eventTimestamp': float(n + 2),
+            'eventType': 'ActivityTaskCompleted',
+            'activityTaskCompletedEventAttributes': {
+                'scheduledEventId': n, 'startedEventId': n + 1,
+                'result': '{"sum": 6}'},
+        })
+    return events[:size][::-1]
+
+
+def decision(events=()):
+    domain = BenchDomain(None)
+    return Decision({
+        'events': list(events),
+        'previousStartedEventId': 0,
+        'startedEventId': len(events),
+        'taskToken': 'token',
+        'workflowExecution': {'workflowId': 'bench', 'runId': 'r'},
+        'workflowType': {'name': 'BenchWorkflow', 'version': '1.0'},
+    }, BenchWorkflow(domain))
+
+
+def wide_flow(width):
+    flow = Flow(props={'width': width})
+    root = Node(flow)
+    sink = Node(flow)
+    for n in range(width):
+        node = ActivityNode(flow, activity_type=__name__ + '.BenchActivity')
+        node.result = [n] * 10
+        root.connect(node).connect(sink)
+    return flow
+
+
+def deep_flow(depth):
+    flow = Flow()
+    node = Node(flow)
+    for _ in range(depth - 1):
+        node = node.connect(Node(flow))
+    return flow
+
+
+for size in (1000, 10000):
+    @benchmark('events.Event', ops=size, events=size)
+    def event_construction(size=size):
+        history = raw_history(size)
+        return lambda: [Event(r) for r in history]
+
+    @benchmark('Decision.filter', events=size)
+    def decision_filter(size=size):
+        task = decision(raw_history(size))
+        return lambda: task.filter('ActivityTaskCompleted')
+
+    @benchmark('Decision.most_recent', events=size)
+    def decision_most_recent(size=size):
+        # The start event is the oldest, so every event is looked at.
+        task = decision(raw_history(size))
+        return lambda: task.most_recent('WorkflowExecutionStarted')
+
+for width in (100, 1000):
+    @benchmark('Flow.decide wide', nodes=width)
+    def decide_wide(width=width):
+        flow, task = wide_flow(width), decision()
+        return lambda: flow.decide(task)
+
+    @benchmark('Flow.decide deep', nodes=width)
+    def decide_deep(width=width):
+        flow, task = deep_flow(width), decision()
+        return lambda: flow.decide(task)
+
+for width in (1000, 10000):
+    @benchmark('freeze', nodes=width)
+    def bench_freeze(width=width):
+        flow = wide_flow(width)
+        return lambda: freeze(flow)
+
+    @benchmark('unfreeze', nodes=width)
+    def bench_unfreeze(width=width):
+        state = json.loads(json.dumps(freeze(wide_flow(width))))
+        return lambda: unfreeze(state)
+
+    @benchmark('Flow.copy', nodes=width)
+    def bench_copy(width=width):
+        flow = wide_flow(width)
+        return flow.copy
+
+for count in (100, 1000):
+    @benchmark('Activity.schedule', ops=count, activities=count)
+    def activity_schedule(count=count):
+        task = decision()
+
+        def run():
+            for n in range(count):
+                task.schedule(BenchActivity, str(n), {'n': n})
+        return run
+
+for size in (100, 10000, 1000000):
+    @benchmark('serializing round-trip', payload_bytes=size)
+    def serializing_round_trip(size=size):
+        payload = {'items': ['x' * 90] * (size // 100)}
+        return lambda: serializing.loads(serializing.dumps(payload))
+
+
+def key(name, params):
+    return '%s %s' % (name, ' '.join('%s=%s' % p for p in sorted(params.items())))
+
+
+def run(runs, pattern=None):
+    """Generate ``(key, result)`` of the benchmarks matching ``pattern``. """
+    for name, params, ops, setup in _benchmarks:
+        k = key(name, params)
+        if pattern and not re.search(pattern, k):
+            continue
+        timings = []
+        for _ in range(runs):
+            func = setup()
+            start = time.time()
+            func()
+            timings.append((time.time() - start) / ops)
+        timings.sort()
+        yield k, {
+            'name': name,
+            'params': params,
+            'best': timings[0],
+            'median': timings[len(timings) // 2],
+            'runs': runs,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--runs', type=int, default=5)
+    parser.add_argument('-k', '--filter', help="Regex of benchmarks to run")
+    parser.add_argument('-o', '--output', help="Write results to JSON file")
+    parser.add_argument('-c', '--compare', help="Earlier JSON results")
+    args = parser.parse_args()
+
+    previous = {}
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)['results']
+
+    print('%-50s %15s %15s' % ('benchmark', 'best', 'median'))
+    results = {}
+    for k, result in run(args.runs, args.filter):
+        results[k] = result
+        line = '%-50s %12.3f us %12.3f us' % (
+                k, result['best'] * 1e6, result['median'] * 1e6)
+        if k in previous:
+            line += '  %.2fx' % (result['best'] / previous[k]['best'])
+        print(line)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'time': time.time(),
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+"""Import-time benchmark.
+
+Measures the wall time of importing flowser modules in a fresh interpreter
+and checks that ``flowser`` and ``flowser.flow`` import without boto.
+
+    $ python benchmarks/import_time.py [-n RUNS]
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCRIPT = """
+import sys, time
+start = time.time()
+import %s
+print('%%f %%d' %% (time.time() - start, 'boto' in sys.modules))
+"""
+
+# Module -> whether importing it may load boto.
+MODULES = [
+    ('flowser', False),
+    ('flowser.flow', False),
+    ('flowser.domain', True),
+]
+
+
+def measure(module, runs):
+    best = None
+    for _ in range(runs):
+        out = subprocess.check_output(
+                [sys.executable, '-c', SCRIPT % module],
+                cwd=ROOT)
+        elapsed, boto_loaded = out.split()
+        elapsed = float(elapsed)
+        best = elapsed if best is None else min(best, elapsed)
+    return best, bool(int(boto_loaded))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--runs', type=int, default=5)
+    args = parser.parse_args()
+    failed = False
+    for module, boto_allowed in MODULES:
+        best, boto_loaded = measure(module, args.runs)
+        print('%-16s %8.2f ms  boto=%s' % (module, best * 1000, boto_loaded))
+        if boto_loaded and not boto_allowed:
+            print('  error: %s must not import boto' % module)
+            failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
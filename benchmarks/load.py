@@ -0,0 +1,228 @@
+"""Load generation.
+
+Starts workflows at a fixed rate through ``Domain.start`` while decider and
+activity worker threads run them. Each workflow schedules ``--activities``
+activities at once, which take ``--work`` seconds, and completes when all
+of them have. Reports throughput and p50/p95/p99 latencies of starting,
+of whole workflows (start to completion decided) and, from the execution
+histories, of each stage of decision and activity tasks.
+
+Runs against an in-memory fake (see fake_swf.py) unless a connection
+factory is given:
+
+    $ python benchmarks/load.py --rate 50 --duration 20 --deciders 4
+    $ python benchmarks/load.py --connect boto.connect_swf --domain load
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from uuid import uuid4
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_swf import FakeSWF, Closed
+from flowser.analysis import Distribution, LatencyAnalyzer
+from flowser.concurrency import bounded_map
+from flowser.domain import Domain
+from flowser.flow.utils import eval_clspath
+from flowser.tasks import WorkflowExecution
+from flowser.types import Activity, Workflow
+
+
+class LoadActivity(Activity):
+    name = 'LoadActivity'
+    version = '1.0'
+    task_list = 'load-activities'
+
+
+class LoadWorkflow(Workflow):
+    name = 'LoadWorkflow'
+    version = '1.0'
+    task_list = 'load-decisions'
+
+
+class LoadDomain(Domain):
+    name = 'flowser-load'
+    workflow_types = [LoadWorkflow]
+    activity_types = [LoadActivity]
+
+
+class Load(object):
+
+    def __init__(self, domain, activities=3, work=0.0):
+        self.domain = domain
+        self.activities = activities
+        self.work = work
+        self.started = {}
+        self.completed = {}
+        self.errors = []
+        self.stages = {'start': Distribution(), 'workflow': Distribution()}
+
+    def start(self, workflow_id, due=None):
+        if due is not None:
+            time.sleep(max(0, due - time.time()))
+        begin = time.time()
+        self.domain.start(LoadWorkflow, workflow_id,
+                          {'activities': self.activities})
+        self.stages['start'].add(time.time() - begin)
+        self.started[workflow_id] = begin
+
+    def decide(self, task):
+        count = task.start_input['activities']
+        done = False
+        if not task.filter('ActivityTaskScheduled'):
+            for n in range(count):
+                task.schedule(LoadActivity, 'activity-%d' % n, n)
+        elif len(task.filter('ActivityTaskCompleted')) == count:
+            task.workflow_execution.complete(count)
+            done = True
+        task.complete()
+        if done:
+            execution = task.workflow_execution
+            self.completed[execution.workflow_id] = (execution.run_id,
+                                                     time.time())
+
+    def work_on(self, task):
+        if self.work:
+            time.sleep(self.work)
+        task.complete(task.input)
+
+    def serve(self, tasks, handle):
+        try:
+            for task in tasks:
+                try:
+                    handle(task)
+                except Exception as e:
+                    self.errors.append(e)
+        except Closed:
+            pass
+
+    def run(self, rate, duration, deciders=1, workers=1, max_pollers=1,
+            starters=8, timeout=60):
+        threads = []
+        for _ in range(deciders):
+            threads.append(threading.Thread(target=self.serve, args=(
+                self.domain.decisions(LoadWorkflow, max_pollers), self.decide)))
+        for _ in range(workers):
+            threads.append(threading.Thread(target=self.serve, args=(
+                self.domain.activities(LoadActivity, max_pollers),
+                self.work_on)))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        # Starts are spread evenly, rather than in bursts of a rate limiter.
+        prefix = uuid4().hex[:8]
+        begin = time.time()
+        starts = [('%s-%d' % (prefix, n), begin + n / float(rate))
+                  for n in range(int(rate * duration))]
+        for _, _, error in bounded_map(lambda item: self.start(*item),
+                                       starts, workers=starters):
+            if error is not None:
+                self.errors.append(error)
+        deadline = time.time() + timeout
+        while len(self.completed) < len(self.started) and \
+                time.time() < deadline:
+            time.sleep(0.1)
+        elapsed = time.time() - begin
+
+        for workflow_id, (_, completed) in self.completed.items():
+            self.stages['workflow'].add(completed - self.started[workflow_id])
+        analyzer = LatencyAnalyzer()
+        analyzer.analyze(WorkflowExecution(
+            {'workflowId': workflow_id, 'runId': run_id},
+            LoadWorkflow(self.domain))
+            for workflow_id, (run_id, _) in self.completed.items())
+        return elapsed, analyzer
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rate', type=float, default=20,
+                        help="Workflows started per second")
+    parser.add_argument('--duration', type=float, default=10,
+                        help="Seconds to start workflows for")
+    parser.add_argument('--deciders', type=int, default=2)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--max-pollers', type=int, default=1,
+                        help="Pollers per decider and worker")
+    parser.add_argument('--starters', type=int, default=8,
+                        help="Threads starting workflows")
+    parser.add_argument('--activities', type=int, default=3,
+                        help="Activities per workflow")
+    parser.add_argument('--work', type=float, default=0.0,
+                        help="Seconds each activity takes")
+    parser.add_argument('--timeout', type=float, default=60,
+                        help="Seconds to wait for workflows to complete")
+    parser.add_argument('--connect', default=None,
+                        help="Dotted path of a connection factory "
+                             "(default: in-memory fake)")
+    parser.add_argument('--domain', default=LoadDomain.name)
+    parser.add_argument('--register', action='store_true')
+    parser.add_argument('-o', '--output', help="Write results to JSON file")
+    args = parser.parse_args()
+
+    if args.connect:
+        conn = eval_clspath(args.connect)()
+    else:
+        conn = FakeSWF()
+    domain = LoadDomain(conn)
+    domain.name = args.domain
+    if args.register:
+        domain.register()
+
+    load = Load(domain, activities=args.activities, work=args.work)
+    elapsed, analyzer = load.run(args.rate, args.duration,
+                                 deciders=args.deciders, workers=args.workers,
+                                 max_pollers=args.max_pollers,
+                                 starters=args.starters,
+                                 timeout=args.timeout)
+    if hasattr(conn, 'close'):
+        # Ends the polling loops, then wait for their poller threads.
+        conn.close()
+        for thread in threading.enumerate():
+            if thread is not threading.current_thread():
+                thread.join(5)
+
+    stages = dict(load.stages)
+    for (kind, _, measurement), dist in analyzer.distributions.items():
+        # Merged over activity types and task lists
+        merged = stages.setdefault('%s %s' % (kind, measurement),
+                                   Distribution())
+        for value in dist.values:
+            merged.add(value)
+
+    print('started %d, completed %d, errors %d in %.1f s: %.1f workflows/s'
+          % (len(load.started), len(load.completed), len(load.errors),
+             elapsed, len(load.completed) / elapsed))
+    print('%-30s %7s %9s %9s %9s %9s' % (
+            'stage (ms)', 'count', 'p50', 'p95', 'p99', 'max'))
+    results = {}
+    for name in sorted(stages):
+        dist = stages[name]
+        if not dist.count:
+            continue
+        results[name] = dist.summary()
+        results[name]['p95'] = dist.percentile(95)
+        print('%-30s %7d %9.1f %9.1f %9.1f %9.1f' % (
+                name, dist.count, dist.percentile(50) * 1000,
+                dist.percentile(95) * 1000, dist.percentile(99) * 1000,
+                dist.percentile(100) * 1000))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'args': vars(args),
+                'started': len(load.started),
+                'completed': len(load.completed),
+                'errors': len(load.errors),
+                'seconds': elapsed,
+                'stages': results,
+            }, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
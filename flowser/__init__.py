@@ -18,8 +18,49 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-from flowser.domain import Domain
-from flowser import types
-from flowser import tasks
-from flowser import exceptions
+"""Flowser.
 
+The public names below are imported on first access, so that importing
+``flowser`` (or ``flowser.flow``, which does not need boto at all) does not
+pull in boto until a name that needs it is used.
+"""
+from __future__ import absolute_import
+
+import sys
+from importlib import import_module
+from types import ModuleType
+
+# Public name -> (module, attribute or None for the module itself).
+_lazy = {
+    'Domain': ('flowser.domain', 'Domain'),
+    'types': ('flowser.types', None),
+    'tasks': ('flowser.tasks', None),
+    'exceptions': ('flowser.exceptions', None),
+}
+
+__all__ = sorted(_lazy)
+
+
+class _LazyModule(ModuleType):
+
+    def __getattr__(self, name):
+        try:
+            module_name, attr = _lazy[name]
+        except KeyError:
+            raise AttributeError(name)
+        value = import_module(module_name)
+        if attr is not None:
+            value = getattr(value, attr)
+        setattr(self, name, value)
+        return value
+
+    def __dir__(self):
+        return sorted(set(self.__dict__) | set(_lazy))
+
+
+_module = _LazyModule(__name__, __doc__)
+_module.__dict__.update(dict((k, v) for k, v in globals().items()
+                             if k.startswith('__') or k == '_lazy'))
+# Keep the original module alive; its globals are cleared when collected.
+_module._original = sys.modules[__name__]
+sys.modules[__name__] = _module
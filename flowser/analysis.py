@@ -0,0 +1,263 @@
+# Copyright (c) 2012 Memoto AB
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""Latency analysis of execution histories.
+
+``LatencyAnalyzer`` pairs the events of one or many histories and collects
+the time spent in each stage:
+
+* Activities, per (activity type, task list): ``schedule_to_start`` (time
+  queued until a worker polled the task), ``start_to_close`` (time worked)
+  and ``schedule_to_close``.
+* Decisions, per task list: ``schedule_to_start`` (decision lag) and
+  ``start_to_close`` (time the decider took).
+* Timers, per timer id: ``lateness``, the time from the requested fire time
+  until the timer fired.
+* Child workflows, per workflow type: ``initiated_to_start`` and
+  ``start_to_close``.
+
+A long ``schedule_to_start`` means a task list needs more pollers, a long
+``start_to_close`` slow work. Example::
+
+    analyzer = LatencyAnalyzer()
+    analyzer.analyze(MyWorkflow(domain).iter_closed(window=3600))
+    print analyzer.report()
+"""
+from flowser.concurrency import bounded_chain
+
+_close_events = set([
+    'WorkflowExecutionCompleted',
+    'WorkflowExecutionFailed',
+    'WorkflowExecutionTimedOut',
+    'WorkflowExecutionCanceled',
+    'WorkflowExecutionContinuedAsNew',
+    'WorkflowExecutionTerminated',
+])
+
+_activity_close_events = set([
+    'ActivityTaskCompleted',
+    'ActivityTaskFailed',
+    'ActivityTaskTimedOut',
+    'ActivityTaskCanceled',
+])
+
+_child_close_events = set([
+    'ChildWorkflowExecutionCompleted',
+    'ChildWorkflowExecutionFailed',
+    'ChildWorkflowExecutionTimedOut',
+    'ChildWorkflowExecutionCanceled',
+    'ChildWorkflowExecutionTerminated',
+])
+
+
+class Distribution(object):
+    """Collected values (seconds) of one measurement. """
+
+    def __init__(self):
+        self.values = []
+        self._sorted = True
+
+    def add(self, value):
+        if self.values and value < self.values[-1]:
+            self._sorted = False
+        self.values.append(value)
+
+    @property
+    def count(self):
+        return len(self.values)
+
+    @property
+    def mean(self):
+        return sum(self.values) / float(len(self.values))
+
+    def percentile(self, p):
+        """Nearest-rank percentile, ``p`` between 0 and 100. """
+        if not self._sorted:
+            self.values.sort()
+            self._sorted = True
+        rank = int(round(p / 100.0 * (len(self.values) - 1)))
+        return self.values[rank]
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.mean,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'max': self.percentile(100),
+        }
+
+
+class LatencyAnalyzer(object):
+
+    def __init__(self):
+        # (kind, key, measurement) -> Distribution
+        self.distributions = {}
+        # Per execution, events waiting for the event closing them
+        self._pending = {}
+
+    def _observe(self, kind, key, measurement, seconds):
+        k = (kind, key, measurement)
+        if k not in self.distributions:
+            self.distributions[k] = Distribution()
+        self.distributions[k].add(seconds)
+
+    def add(self, events, execution=None):
+        """Analyze a history given as events in ascending order. """
+        for ev in events:
+            self.add_event(ev, execution)
+        self._pending.pop(execution, None)
+
+    def add_event(self, ev, execution=None):
+        """Analyze the next event of ``execution`` (any hashable key).
+
+        Events of different executions may be interleaved.
+        """
+        pending = self._pending.setdefault(execution, {})
+        handler = getattr(self, '_on_' + ev.type, None)
+        if handler is not None:
+            handler(ev, pending)
+        elif ev.type in _activity_close_events:
+            self._on_activity_closed(ev, pending)
+        elif ev.type in _child_close_events:
+            self._on_child_closed(ev, pending)
+        elif ev.type in _close_events:
+            del self._pending[execution]
+
+    def analyze(self, executions, workers=4):
+        """Analyze the histories of ``tasks.WorkflowExecution`` instances,
+        fetched by ``workers`` threads. """
+        for execution, ev, error in bounded_chain(
+                lambda e: e.history(), executions, workers):
+            if error is not None:
+                raise error
+            self.add_event(ev, (execution.workflow_id, execution.run_id))
+        self._pending.clear()
+
+    # Activities
+
+    def _on_ActivityTaskScheduled(self, ev, pending):
+        key = (ev.attrs['activityType']['name'], ev.attrs['taskList']['name'])
+        pending[ev.id] = (key, ev.time_stamp)
+
+    def _on_ActivityTaskStarted(self, ev, pending):
+        scheduled = pending.get(ev.attrs['scheduledEventId'])
+        if scheduled is not None:
+            key, time_stamp = scheduled
+            self._observe('activity', key, 'schedule_to_start',
+                          ev.time_stamp - time_stamp)
+            pending[ev.id] = (key, ev.time_stamp)
+
+    def _on_activity_closed(self, ev, pending):
+        scheduled = pending.pop(ev.attrs['scheduledEventId'], None)
+        started = pending.pop(ev.attrs.get('startedEventId'), None)
+        if scheduled is not None:
+            key, time_stamp = scheduled
+            self._observe('activity', key, 'schedule_to_close',
+                          ev.time_stamp - time_stamp)
+        if started is not None:
+            key, time_stamp = started
+            self._observe('activity', key, 'start_to_close',
+                          ev.time_stamp - time_stamp)
+
+    # Decisions
+
+    def _on_DecisionTaskScheduled(self, ev, pending):
+        pending[ev.id] = (ev.attrs['taskList']['name'], ev.time_stamp)
+
+    def _on_DecisionTaskStarted(self, ev, pending):
+        scheduled = pending.pop(ev.attrs['scheduledEventId'], None)
+        if scheduled is not None:
+            key, time_stamp = scheduled
+            self._observe('decision', key, 'schedule_to_start',
+                          ev.time_stamp - time_stamp)
+            pending[ev.id] = (key, ev.time_stamp)
+
+    def _on_DecisionTaskCompleted(self, ev, pending):
+        started = pending.pop(ev.attrs['startedEventId'], None)
+        if started is not None:
+            key, time_stamp = started
+            self._observe('decision', key, 'start_to_close',
+                          ev.time_stamp - time_stamp)
+
+    def _on_DecisionTaskTimedOut(self, ev, pending):
+        pending.pop(ev.attrs['startedEventId'], None)
+
+    # Timers
+
+    def _on_TimerStarted(self, ev, pending):
+        due = ev.time_stamp + float(ev.attrs['startToFireTimeout'])
+        pending[ev.id] = (ev.attrs['timerId'], due)
+
+    def _on_TimerFired(self, ev, pending):
+        started = pending.pop(ev.attrs['startedEventId'], None)
+        if started is not None:
+            key, due = started
+            self._observe('timer', key, 'lateness', ev.time_stamp - due)
+
+    def _on_TimerCanceled(self, ev, pending):
+        pending.pop(ev.attrs['startedEventId'], None)
+
+    # Child workflows
+
+    def _on_StartChildWorkflowExecutionInitiated(self, ev, pending):
+        pending[ev.id] = (ev.attrs['workflowType']['name'], ev.time_stamp)
+
+    def _on_StartChildWorkflowExecutionFailed(self, ev, pending):
+        pending.pop(ev.attrs['initiatedEventId'], None)
+
+    def _on_ChildWorkflowExecutionStarted(self, ev, pending):
+        initiated = pending.pop(ev.attrs['initiatedEventId'], None)
+        if initiated is not None:
+            key, time_stamp = initiated
+            self._observe('child', key, 'initiated_to_start',
+                          ev.time_stamp - time_stamp)
+            pending[ev.id] = (key, ev.time_stamp)
+
+    def _on_child_closed(self, ev, pending):
+        started = pending.pop(ev.attrs['startedEventId'], None)
+        if started is not None:
+            key, time_stamp = started
+            self._observe('child', key, 'start_to_close',
+                          ev.time_stamp - time_stamp)
+
+    def summary(self):
+        """Dict of kind -> key -> measurement -> summary. """
+        result = {}
+        for (kind, key, measurement), dist in self.distributions.iteritems():
+            result.setdefault(kind, {}).setdefault(key, {})[measurement] = \
+                    dist.summary()
+        return result
+
+    def report(self):
+        """Text table of the distributions, in seconds. """
+        lines = ['%-50s %-18s %7s %9s %9s %9s %9s' % (
+                'key', 'measurement', 'count', 'p50', 'p90', 'p99', 'max')]
+        for kind, key, measurement in sorted(self.distributions):
+            dist = self.distributions[(kind, key, measurement)]
+            if isinstance(key, tuple):
+                key = '/'.join(key)
+            lines.append('%-50s %-18s %7d %9.3f %9.3f %9.3f %9.3f' % (
+                    '%s %s' % (kind, key), measurement, dist.count,
+                    dist.percentile(50), dist.percentile(90),
+                    dist.percentile(99), dist.percentile(100)))
+        return '\n'.join(lines)
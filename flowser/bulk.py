@@ -0,0 +1,109 @@
+# Copyright (c) 2012 Memoto AB
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""Bulk operations over sets of workflow executions.
+
+The functions take any iterable of ``tasks.WorkflowExecution`` instances,
+such as ``types.Workflow.iter_open()``, and call the matching method on
+each from a pool of threads. They return the failures as a list of
+``(execution, error)`` pairs::
+
+    failures = bulk.terminate_all(workflow.iter_open(), reason='cleanup',
+                                  rate=20, progress=log_progress)
+"""
+import time
+
+from flowser.concurrency import bounded_map
+
+
+class Progress(object):
+    """Counts of a running bulk operation. """
+
+    def __init__(self):
+        self.started = time.time()
+        self.done = 0
+        self.failed = 0
+
+    @property
+    def rate(self):
+        "Executions per second so far. "
+        return self.done / max(time.time() - self.started, 1e-3)
+
+    def __str__(self):
+        return "%d done (%d failed), %.1f/s" % (
+                self.done, self.failed, self.rate)
+
+    def __repr__(self):
+        return "<Progress %s>" % self
+
+
+def iter_apply(executions, method_name, args=(), kwargs=None, workers=8,
+               rate=None, progress=None, progress_every=100):
+    """Call a ``tasks.WorkflowExecution`` method on every execution.
+
+    :param progress: Callable taking a ``Progress`` instance, called every
+                     ``progress_every`` executions and once at the end.
+    :param rate: Maximum calls per second (optional).
+    :returns: Generator of ``(execution, error)`` pairs in completion order.
+    """
+    kwargs = kwargs or {}
+    counts = Progress()
+
+    def call(execution):
+        getattr(execution, method_name)(*args, **kwargs)
+
+    for execution, _, error in bounded_map(call, executions, workers, rate):
+        counts.done += 1
+        if error is not None:
+            counts.failed += 1
+        if progress is not None and counts.done % progress_every == 0:
+            progress(counts)
+        yield execution, error
+    if progress is not None:
+        progress(counts)
+
+
+def _failures(results):
+    return [(execution, error) for execution, error in results
+            if error is not None]
+
+
+def signal_all(executions, name, input=None, **options):
+    """Signal every execution. See ``iter_apply`` for ``options``. """
+    return _failures(iter_apply(executions, 'signal', (name, input),
+                                **options))
+
+
+def request_cancel_all(executions, **options):
+    """Request cancellation of every execution. """
+    return _failures(iter_apply(executions, 'request_cancel', **options))
+
+
+def terminate_all(executions, details=None, reason=None, **options):
+    """Terminate every execution. """
+    return _failures(iter_apply(executions, 'terminate', (details, reason),
+                                **options))
+
+
+def abandon_all(executions, details=None, reason=None, **options):
+    """Terminate every execution, abandoning child executions. """
+    return _failures(iter_apply(executions, 'abandon', (details, reason),
+                                **options))
@@ -0,0 +1,152 @@
+# Copyright (c) 2012 Memoto AB
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""Concurrency helpers for bulk API calls.
+
+``bounded_map`` fans calls out over a pool of threads while consuming its
+input lazily, so it can be fed from a generator of any length.
+``bounded_chain`` does the same for calls returning iterables (e.g. paged
+listings). ``RateLimiter`` keeps the calls under an API rate.
+"""
+import threading
+import time
+from Queue import Queue, Empty, Full
+
+_DONE = object()
+_FEED_ERROR = object()
+
+
+class RateLimiter(object):
+    """Token bucket allowing ``rate`` calls per second on average and bursts
+    of up to ``burst`` calls. Thread-safe. """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = burst or max(1, int(rate))
+        self._tokens = float(self.burst)
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        "Block until a call is allowed. "
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.burst,
+                               self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+def bounded_map(func, items, workers=8, rate=None):
+    """Call ``func`` on every item from ``workers`` threads.
+
+    Yields ``(item, result, error)`` tuples in completion order, where
+    ``error`` is the exception raised by ``func`` (or None). At most a few
+    items per worker are read ahead from ``items``. Closing the generator
+    stops the workers once their calls in flight return.
+
+    :param rate: Maximum calls per second (optional).
+    """
+    return _fan_out(lambda item: [func(item)], items, workers, rate)
+
+
+def bounded_chain(func, items, workers=8, rate=None):
+    """Like ``bounded_map`` for a ``func`` returning an iterable.
+
+    Yields ``(item, value, error)`` for every value of every ``func(item)``
+    as soon as it is produced, so that at most a few values per worker are
+    held in memory. An exception while iterating ends that item with an
+    ``(item, None, error)`` tuple.
+    """
+    return _fan_out(func, items, workers, rate)
+
+
+def _fan_out(func, items, workers, rate):
+    limiter = RateLimiter(rate) if rate else None
+    todo = Queue(maxsize=workers * 2)
+    done = Queue(maxsize=workers * 2)
+    stopped = threading.Event()
+
+    def put(queue, entry):
+        while not stopped.is_set():
+            try:
+                queue.put(entry, timeout=0.5)
+                return True
+            except Full:
+                continue
+        return False
+
+    def feed():
+        try:
+            for item in items:
+                if not put(todo, item):
+                    return
+        except Exception as e:
+            put(done, (_FEED_ERROR, None, e))
+        finally:
+            for _ in range(workers):
+                put(todo, _DONE)
+
+    def work():
+        while True:
+            try:
+                item = todo.get(timeout=0.5)
+            except Empty:
+                if stopped.is_set():
+                    return
+                continue
+            if item is _DONE:
+                put(done, _DONE)
+                return
+            if limiter is not None:
+                limiter.acquire()
+            try:
+                for value in func(item):
+                    if not put(done, (item, value, None)):
+                        return
+            except Exception as e:
+                if not put(done, (item, None, e)):
+                    return
+
+    threads = [threading.Thread(target=feed)]
+    threads.extend(threading.Thread(target=work) for _ in range(workers))
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    finished = 0
+    try:
+        while finished < workers:
+            try:
+                entry = done.get(timeout=0.5)
+            except Empty:
+                continue
+            if entry is _DONE:
+                finished += 1
+            elif entry[0] is _FEED_ERROR:
+                raise entry[2]
+            else:
+                yield entry
+    finally:
+        stopped.set()
@@ -18,11 +18,22 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import itertools
+import json
+import os
+import threading
+import time
+
 from boto.swf.exceptions import SWFDomainAlreadyExistsError
 
+from flowser import metrics
 from flowser import tasks
+from flowser import types
+from flowser.concurrency import bounded_map
 from flowser.exceptions import Error
 from flowser.exceptions import EmptyTaskPollResult
+from flowser.polling import AdaptivePoller
+from flowser.polling import PollStats
 
 
 class Domain(object):
@@ -34,27 +45,61 @@ class Domain(object):
     To register types, ``workflow_types`` and ``activity_types`` need to be
     set. They should be lists of ``types.Workflow`` and ``types.Activity``
     subclasses.
+
+    Setting ``registration_cache`` to a file path makes ``register`` record
+    what it registered there and skip all API calls on later runs when
+    nothing is missing. Delete the file after deprecating types.
     """
 
     retention_period = '30'
     workflow_types = None
     activity_types = None
+    registration_cache = None
 
     def __init__(self, conn):
         """
         :param conn: A ``boto.swf`` connection.
         """
         self.conn = conn
+        # Poll statistics (``polling.PollStats``) keyed by ``(kind,
+        # task_list)``, where kind is 'decision' or 'activity' and task_list
+        # the polled list (each shard of a sharded type has its own).
+        self.poll_stats = {}
+
+    def register(self, raise_exists=False, workers=8):
+        """Register domain and associated types on AWS.
 
-    def register(self, raise_exists=False):
-        "Register domain and associated types on AWS. " 
+        Registered types are listed once and only the missing ones are
+        registered, ``workers`` at a time.
+        """
+        all_types = (self.workflow_types or []) + (self.activity_types or [])
+        cache = None
+        if self.registration_cache and not raise_exists:
+            cache = _RegistrationCache(self.registration_cache)
+            if cache.covers(self, all_types):
+                return
         try:
             self.conn.register_domain(self.name, self.retention_period)
         except SWFDomainAlreadyExistsError:
             if raise_exists:
                 raise Error(self)
-        types = (self.workflow_types or []) + (self.activity_types or [])
-        [t(self)._register(raise_exists=raise_exists) for t in types]
+        missing = []
+        for kind in (types.Workflow, types.Activity):
+            kind_types = [t for t in all_types if issubclass(t, kind)]
+            if not kind_types:
+                continue
+            registered = kind._registered(self)
+            for t in kind_types:
+                if (t.name, t.version) not in registered:
+                    missing.append(t)
+                elif raise_exists:
+                    raise Error(t(self))
+        register = lambda t: t(self)._register(raise_exists=raise_exists)
+        for _, _, error in bounded_map(register, missing, workers):
+            if error is not None:
+                raise error
+        if cache is not None:
+            cache.add(self, all_types)
 
     def start(self, t, workflow_id, input):
         """Start execution.
@@ -66,37 +111,139 @@ class Domain(object):
         """
         return t(self)._start(workflow_id, input)
 
-    def decisions(self, t):
+    def start_many(self, t, items, workers=8, rate=None):
+        """Start many executions concurrently.
+
+        ``items`` is consumed lazily, so it may be a generator. A failing
+        start (e.g. a duplicate workflow id) is reported and does not stop
+        the others.
+
+        :param t: Subclass of ``types.Workflow``.
+        :param items: Iterable of ``(workflow_id, input)`` pairs.
+        :param workers: Number of concurrent start calls.
+        :param rate: Maximum starts per second (optional).
+        :returns: Generator of ``(workflow_id, run_id, error)`` tuples in
+                  completion order. ``run_id`` is None if ``error`` is set.
+        """
+        instance = t(self)
+        template = instance._start_template()
+
+        def start(item):
+            workflow_id, input = item
+            return instance._start(workflow_id, input, template)['runId']
+
+        for item, run_id, error in bounded_map(start, items, workers, rate):
+            yield item[0], run_id, error
+
+    def decisions(self, t, max_pollers=1, min_pollers=1):
         """High-level interface to iterate over decision tasks.
 
         This method polls for new tasks of the given type indefinitely.
 
         :param t: Subclass of ``types.Type``.
+        :param max_pollers: Upper bound of concurrent long polls. If greater
+                            than one, the number of pollers adapts to the
+                            empty-poll ratio (see ``polling.AdaptivePoller``).
+        :param min_pollers: Lower bound of concurrent long polls.
         """
         poll_kwargs = {'reverse_order': True}
         return self._poll_indefinitely(
-                t, '_poll_for_decision_task', tasks.Decision, poll_kwargs)
+                t, '_poll_for_decision_task', tasks.Decision, poll_kwargs,
+                max_pollers=max_pollers, min_pollers=min_pollers)
 
-    def activities(self, t):
+    def activities(self, t, max_pollers=1, min_pollers=1):
         """High-level interface to iterate over activity tasks.
 
         This method polls for new tasks of the given type indefinitely.
 
         :param t: Subclass of ``types.Type``.
+        :param max_pollers: See ``decisions``.
+        :param min_pollers: See ``decisions``.
         """
         return self._poll_indefinitely(
-                t, '_poll_for_activity_task', tasks.Activity)
+                t, '_poll_for_activity_task', tasks.Activity,
+                max_pollers=max_pollers, min_pollers=min_pollers)
 
-    def _poll_indefinitely(self, t, method_name, task_class, poll_kwargs=None):
+    def _stats_for(self, kind, task_list):
+        return self.poll_stats.setdefault((kind, task_list), PollStats())
+
+    def _poll_indefinitely(self, t, method_name, task_class, poll_kwargs=None,
+                           max_pollers=1, min_pollers=1):
         instance = t(self)
-        poll_method = getattr(instance, method_name)
+        kind = 'decision' if issubclass(t, types.Workflow) else 'activity'
+        # Sharded types are polled round-robin over their shards.
+        shards = itertools.cycle(instance._shard_instances())
+        shards_lock = threading.Lock()
         kwargs = {}
         if poll_kwargs is not None:
             kwargs.update(poll_kwargs)
+
+        def poll():
+            with shards_lock:
+                shard = next(shards)
+            tags = {'task_list': shard.task_list}
+            stats = self._stats_for(kind, shard.task_list)
+            start = time.time()
+            try:
+                result = getattr(shard, method_name)(**kwargs)
+            except EmptyTaskPollResult:
+                metrics.incr('poll.empty', tags=tags)
+                stats.record(False)
+                raise
+            else:
+                stats.record(True)
+                return shard, result
+            finally:
+                metrics.observe('poll.seconds', time.time() - start, tags)
+
+        def handled(task):
+            # Time from handing out the task to being asked for the next one.
+            start = time.time()
+            yield task
+            metrics.observe('handler.seconds', time.time() - start,
+                            {'type': instance.name})
+
+        if max_pollers > 1:
+            # The poller keeps stats of its own, over all shards, to scale.
+            poller = AdaptivePoller(poll,
+                                    min_pollers=min_pollers,
+                                    max_pollers=max_pollers)
+            for shard, result in poller:
+                for task in handled(task_class(result, shard)):
+                    yield task
+            return
         while True:
             try:
-                result = poll_method(**kwargs)
+                shard, result = poll()
             except EmptyTaskPollResult:
                 continue
-            else:
-                yield task_class(result, instance)
+            for task in handled(task_class(result, shard)):
+                yield task
+
+
+class _RegistrationCache(object):
+    """Registered (domain, kind, name, version) keys kept in a JSON file. """
+
+    def __init__(self, path):
+        self.path = path
+
+    def _keys(self, domain, type_classes):
+        return set((domain.name, t._type_info_key, t.name, t.version)
+                   for t in type_classes)
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return set(tuple(k) for k in json.load(f))
+        except (IOError, ValueError):
+            return set()
+
+    def covers(self, domain, type_classes):
+        return self._keys(domain, type_classes) <= self._load()
+
+    def add(self, domain, type_classes):
+        keys = self._load() | self._keys(domain, type_classes)
+        tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(sorted(keys), f)
+        os.rename(tmp_path, self.path)
@@ -83,6 +83,7 @@ _attr_key_lookup = dict(zip(_event_types, _attr_keys))
 
 _auto_unserialize_attrs = {
         "ActivityTaskCompleted": ['result'],
+        "ChildWorkflowExecutionCompleted": ['result'],
         }
 
 def attrs(result):
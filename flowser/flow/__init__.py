@@ -2,3 +2,11 @@ from .base import *
 from .utils import freeze, unfreeze, get_clspath, eval_clspath
 from .activitynode import ActivityNode
 from .timernode import TimerNode
+from .mapnode import MapNode, TreeReduceNode
+from .childnode import ChildWorkflowNode
+from .localnode import LocalActivityNode, local_activity
+from .snapshot import freeze_delta, apply_delta, Snapshots
+from .plan import Plan, CycleError
+from .cache import ResultCache, MemoryResultStore, SqliteResultStore
+from .governor import Governor, MemoryLeaseStore, SqliteLeaseStore
+from .profile import Profiler
@@ -16,24 +16,46 @@ class ActivityNode(Node):
     def failed(self):
         return self.ctx.setdefault('_failed', {})
 
-    def decide(self, task):
-        if not (self.active or self.done or self.failed):
-            return self._schedule(task)
-
-        lastperactivity = self._collect_activity_events(task)
-        for aid, ev in lastperactivity.iteritems():
-            data = self.active.pop(aid)
-            if ev.type == 'ActivityTaskCompleted':
-                self.done[aid] = (ev.attrs.get('result'), data)
-            else:
-                self.failed[aid] = (ev.type, ev.attrs, data)
+    @property
+    def deferred(self):
+        """Activities held back by the flow's governor. """
+        return self.ctx.setdefault('_deferred', {})
 
-        if not self.active:
-            self.result = [r[0] for r in self.done.values() if r[0] is not None]
-            self.status = FAILED if self.failed else SUCCEED
+    def decide(self, task):
+        if not (self.active or self.done or self.failed or self.deferred):
+            self._schedule(task)
+        else:
+            lastperactivity = self._collect_activity_events(task)
+            activity_type = eval_clspath(self.ctx['activity_type'])
+            cache = self._cache()
+            for aid, ev in lastperactivity.iteritems():
+                data = self.active.pop(aid)
+                if ev.type == 'ActivityTaskCompleted':
+                    self.done[aid] = (ev.attrs.get('result'), data)
+                    if cache is not None:
+                        cache.store(cache.key(activity_type, data),
+                                    ev.attrs.get('result'))
+                else:
+                    self.failed[aid] = (ev.type, ev.attrs, data)
+            if lastperactivity and self.flow.governor is not None:
+                self.flow.governor.release(activity_type, [
+                    self._lease(task, aid) for aid in lastperactivity])
+            if self.deferred:
+                self._dispatch(task, activity_type, self.deferred)
+
+        # Events up to here are handled, even if the node is not decided in
+        # the next decision task (see Flow.decide).
+        self.ctx['_seen'] = task.started_event_id
+        if not (self.active or self.deferred):
+            self._finish(task)
+
+    def _finish(self, task):
+        """Called once no scheduled activity is left. """
+        self.result = [r[0] for r in self.done.values() if r[0] is not None]
+        self.status = FAILED if self.failed else SUCCEED
 
     def _collect_activity_events(self, task):
-        recent = _recent_events(task)
+        recent = _recent_events(task, self.ctx.get('_seen'))
         schidmap = self.ctx.setdefault('_schidmap', {})
         lastperactivity = {}
         for ev in recent:
@@ -49,27 +71,94 @@ class ActivityNode(Node):
                 if schid in schidmap:
                     aid = schidmap[schid]
                     lastperactivity[aid] = ev
+            elif ev.type == 'ScheduleActivityTaskFailed':
+                # Never scheduled, so there is no scheduled event id
+                aid = ev.attrs['activityId']
+                if aid in self.active:
+                    lastperactivity[aid] = ev
+            elif ev.type == 'TimerFired':
+                if ev.attrs['timerId'] == self.ctx.get('_timer'):
+                    del self.ctx['_timer']
 
         return lastperactivity
 
     def _schedule(self, task):
+        self._schedule_batches(task, self._batch_input(), self.id)
+
+    def _schedule_batches(self, task, batches, prefix):
         activity_type = eval_clspath(self.ctx['activity_type'])
+        cache = self._cache()
+        pending = {}
+        for idx, input in enumerate(batches):
+            activity_id = '%s-%d' % (prefix, idx)
+            if cache is not None:
+                found, result = cache.lookup(cache.key(activity_type, input))
+                if found:
+                    self.done[activity_id] = (result, input)
+                    continue
+            pending[activity_id] = input
+        self._dispatch(task, activity_type, pending)
+
+    def _dispatch(self, task, activity_type, pending):
+        """Schedule the pending activities the governor allows and defer
+        the others. """
+        governor = self.flow.governor
+        # Batch order, rather than the order of the (ctx) dict
+        ordered = sorted(pending, key=_batch_order)
+        if governor is None:
+            granted = ordered
+        else:
+            leases = [self._lease(task, aid) for aid in ordered]
+            acquired = set(governor.acquire(activity_type, leases))
+            granted = [aid for aid, lease in zip(ordered, leases)
+                       if lease in acquired]
         control = self.ctx.get('control')
-        for idx, input in enumerate(self._batch_input()):
-            activity_id = '%s-%d' % (self.id, idx)
+        for activity_id in granted:
+            input = pending[activity_id]
             self.active[activity_id] = input
             task.schedule(activity_type,
                           activity_id=activity_id,
                           input=input,
                           control=control)
+        deferred = dict((aid, pending[aid]) for aid in pending
+                        if aid not in self.active)
+        self.ctx['_deferred'] = deferred
+        if deferred and not self.active and '_timer' not in self.ctx:
+            # Nothing of ours is running to trigger a decision task
+            self._retry_later(task)
+
+    def _lease(self, task, activity_id):
+        return '%s:%s' % (task.workflow_execution.workflow_id, activity_id)
+
+    def _retry_later(self, task):
+        retries = self.ctx['_retries'] = self.ctx.get('_retries', 0) + 1
+        timer_id = self.ctx['_timer'] = '%s-retry-%d' % (self.id, retries)
+        task.decisions.start_timer(
+                start_to_fire_timeout=str(self.ctx.get('retry_interval', 30)),
+                timer_id=timer_id)
+
+    def _cache(self):
+        """Result cache of the flow, for nodes with ``memoize`` set. """
+        if self.ctx.get('memoize'):
+            return self.flow.result_cache
+        return None
 
     def _batch_input(self):
         return [[i.result for i in self.inputs if i.result is not None]]
 
 
-def _recent_events(task):
+def _batch_order(activity_id):
+    """Sort key of activity ids ending with a batch index. """
+    prefix, _, index = activity_id.rpartition('-')
+    if index.isdigit():
+        return prefix, int(index)
+    return activity_id, -1
+
+
+def _recent_events(task, since=None):
+    """Events after ``since``, by default the previous decision task. """
     events = []
-    previous = task.previous_started_event_id
+    previous = since if since is not None else task.previous_started_event_id
     for ev in task.events:
         if ev.id <= previous:
             break
@@ -1,5 +1,4 @@
-from json import loads, dumps
-from .utils import freeze, unfreeze
+import copy
 
 
 __all__ = ['INACTIVE', 'ACTIVE', 'DONE', 'SUCCEED', 'FAILED', 'CANCELED',
@@ -15,15 +14,29 @@ CANCELED = 32 | DONE
 
 class Flow(object):
 
+    # Cache of activity results for nodes with ``memoize`` set (cache.py)
+    result_cache = None
+
+    # Concurrency limits for activity types (governor.py)
+    governor = None
+
+    # Per-node timings of decide calls (profile.py)
+    profiler = None
+
     def __init__(self, props=None):
         self.idx = 0
         self.props = props or {}
         self.nodes = {}
+        # Ids of nodes changed since the last snapshot (see snapshot.py)
+        self.dirty = set()
+        # Compiled graph shape, until nodes are added or connected (plan.py)
+        self._plan = None
 
     def regnode(self, node, id=None):
         """Register the node within this desicion flow"""
         nid = id or self._nodeid(node)
         self.nodes[nid] = node
+        self._plan = None
         return nid
 
     def _nodeid(self, node):
@@ -32,18 +45,44 @@ class Flow(object):
         return '%s-%d' % (name, self.idx)
 
     def decide(self, task):
-        """Send decision events to nodes in ACTIVE status"""
+        """Send decision events to nodes in ACTIVE status
+
+        If the task gets near its deadline (``tasks.Decision.near_deadline``)
+        the remaining nodes are left for a new decision task, which is
+        requested with ``retrigger``. Returns False in that case. At least
+        one node is decided per call, so that a task near its deadline
+        already when polled still makes progress.
+        """
+        if self.profiler is None:
+            return self._decide(task)
+        with self.profiler.decision(task):
+            return self._decide(task)
+
+    def _decide(self, task):
+        near_deadline = getattr(task, 'near_deadline', lambda: False)
         seen = set()
         active = self._active()
         pending = active - seen
         while pending:
             for n in pending:
+                if seen and near_deadline():
+                    task.retrigger()
+                    return False
                 seen.add(n)
-                n.decide(task)
+                n.touch()
+                self._decide_node(n, task)
             pending = self._active() - seen
 
-        if not self._active() and not task.decisions._data:
+        if not self._active() and not _waiting(task.decisions._data):
             task.workflow_execution.complete('UNKNOWN')
+        return True
+
+    def _decide_node(self, node, task):
+        if self.profiler is None:
+            node.decide(task)
+        else:
+            with self.profiler.node(node, task) as task:
+                node.decide(task)
 
     def _active(self):
         active = set()
@@ -56,30 +95,86 @@ class Flow(object):
         return active
 
     def copy(self):
-        return unfreeze(loads(dumps(freeze(self))))
+        """Clone the flow graph.
+
+        Node results are shared between the clones and must not be mutated
+        in place. Node ctx dicts are shared until first accessed on either
+        clone. Like ``unfreeze``, node status is not carried over.
+        """
+        flow = self.__class__(props=copy.deepcopy(self.props))
+        flow.idx = self.idx
+        clones = {}
+        for nid, node in self.nodes.iteritems():
+            clone = node.__class__(flow, id=nid)
+            clone._ctx = node._ctx
+            clone._result = node._result
+            clone._ctx_shared = node._ctx_shared = True
+            clones[node] = clone
+        for node, clone in clones.iteritems():
+            clone.inputs = set(clones[n] for n in node.inputs)
+            clone.outputs = set(clones[n] for n in node.outputs)
+        flow.dirty.clear()
+        return flow
 
 
 class Node(object):
 
     def __init__(self, flow, id=None, **ctx):
         self.flow = flow
-        self.ctx = ctx
-        self.result = None
+        self._ctx = ctx
+        self._ctx_shared = False
+        self._result = None
         self.inputs = set()
         self.outputs = set()
         self._status = INACTIVE
         self.id = flow.regnode(self, id)
+        self.touch()
+
+    def touch(self):
+        """Mark node as changed since the last snapshot.
+
+        Status, result and ctx assignments and connections do this already.
+        Nodes should only mutate ctx in place from ``decide``, before which
+        the flow touches them.
+        """
+        self.flow.dirty.add(self.id)
+
+    def _ctxget(self):
+        if self._ctx_shared:
+            # Shared with a copy of the flow (see Flow.copy)
+            self._ctx = copy.deepcopy(self._ctx)
+            self._ctx_shared = False
+        return self._ctx
+
+    def _ctxset(self, ctx):
+        self._ctx = ctx
+        self._ctx_shared = False
+        self.touch()
+
+    ctx = property(_ctxget, _ctxset)
+
+    def _resultset(self, result):
+        self._result = result
+        self.touch()
+
+    result = property(lambda x:x._result, _resultset)
 
     def connect(self, output):
         self.outputs.add(output)
         output.inputs.add(self)
+        self.flow._plan = None
+        self.touch()
+        output.touch()
         return output
 
     def _statusset(self, new):
         if self._status == new:
             return
         # status changed
+        if self.flow.profiler is not None:
+            self.flow.profiler.transition(self, self._status, new)
         self._status = new
+        self.touch()
         # notify outputs that one of its inputs changed
         for node in self.outputs:
             node.on_input_status_change(self)
@@ -102,3 +197,9 @@ class Node(object):
 
     def decide(self, task):
         self.status = SUCCEED
+
+
+def _waiting(decisions):
+    """Whether any of the decisions leads to a new decision task. Markers,
+    e.g. from local activities, do not. """
+    return any(d['decisionType'] != 'RecordMarker' for d in decisions)
@@ -0,0 +1,110 @@
+"""Activity result caches.
+
+``ActivityNode`` consults the flow's ``result_cache`` for nodes with
+``memoize`` set in their ctx. Results are keyed by activity type name,
+version and a hash of the serialized input, so a cache hit completes the
+activity without scheduling it.
+
+Results live in a store: ``MemoryResultStore`` (the default) for one
+process, ``SqliteResultStore`` for deciders on one host, or any object with
+the same ``get`` and ``set`` methods.
+"""
+import hashlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from flowser import serializing
+
+__all__ = ['ResultCache', 'MemoryResultStore', 'SqliteResultStore']
+
+
+class ResultCache(object):
+
+    def __init__(self, store=None, ttl=None):
+        """
+        :param store: Result store (default: ``MemoryResultStore``).
+        :param ttl: Seconds until results expire (optional).
+        """
+        self._store = store or MemoryResultStore()
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, activity_type, input):
+        digest = hashlib.sha1(serializing.dumps(input, sort_keys=True))
+        return '%s:%s:%s' % (activity_type.name, activity_type.version,
+                             digest.hexdigest())
+
+    def lookup(self, key):
+        found, value = self._store.get(key)
+        if found:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return found, value
+
+    def store(self, key, value):
+        expires = time.time() + self.ttl if self.ttl is not None else None
+        self._store.set(key, value, expires)
+
+
+class MemoryResultStore(object):
+    """In-memory LRU store of at most ``max_entries`` results. """
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value, expires = self._entries.pop(key)
+            except KeyError:
+                return False, None
+            if expires is not None and expires < time.time():
+                return False, None
+            self._entries[key] = (value, expires)
+            return True, value
+
+    def set(self, key, value, expires):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, expires)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class SqliteResultStore(object):
+    """Results kept in a sqlite database, shared by processes on a host. """
+
+    def __init__(self, path):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS results ('
+                'key TEXT PRIMARY KEY, value TEXT, expires REAL)')
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT value, expires FROM results WHERE key = ?',
+                (key,)).fetchone()
+        if row is None or (row[1] is not None and row[1] < time.time()):
+            return False, None
+        return True, serializing.loads(row[0])
+
+    def set(self, key, value, expires):
+        with self._lock, self._conn:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO results VALUES (?, ?, ?)',
+                (key, serializing.dumps(value), expires))
+
+    def purge(self):
+        """Delete expired entries. """
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM results WHERE expires < ?',
+                               (time.time(),))
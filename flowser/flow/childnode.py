@@ -0,0 +1,92 @@
+from .base import Node, SUCCEED, FAILED
+from .utils import eval_clspath
+from .activitynode import _recent_events
+from .mapnode import _items, _batches, MAX_INPUT_SIZE
+
+_child_close_events = (
+    'ChildWorkflowExecutionCompleted',
+    'ChildWorkflowExecutionFailed',
+    'ChildWorkflowExecutionTimedOut',
+    'ChildWorkflowExecutionCanceled',
+    'ChildWorkflowExecutionTerminated',
+)
+
+
+class ChildWorkflowNode(Node):
+    """Runs a workflow over the upstream results as child executions.
+
+    Items are collected like in ``MapNode`` and split into shards of at most
+    ``shard_size`` items and ``max_input_size`` serialized bytes. Each shard
+    is the input of one child execution of ``workflow_type``, and at most
+    ``max_children`` of them run at a time. The result is the list of child
+    results in shard order. If a child fails, the node fails once all shards
+    have run.
+
+    Shards are recomputed from the inputs when children are started, rather
+    than kept in ctx, so the flow state does not hold every item twice.
+    """
+
+    @property
+    def active(self):
+        return self.ctx.setdefault('_active', {})
+
+    @property
+    def done(self):
+        return self.ctx.setdefault('_done', {})
+
+    @property
+    def failed(self):
+        return self.ctx.setdefault('_failed', {})
+
+    def decide(self, task):
+        if '_count' not in self.ctx:
+            self.ctx['_count'] = len(self._shards())
+            self.ctx['_next'] = 0
+        else:
+            self._collect_child_events(task)
+
+        self.ctx['_seen'] = task.started_event_id
+        self._start_children(task)
+
+        if not self.active and self.ctx['_next'] == self.ctx['_count']:
+            self.result = [self.done[k] for k in sorted(self.done, key=int)]
+            self.status = FAILED if self.failed else SUCCEED
+
+    def _shards(self):
+        return _batches(_items(sorted(self.inputs, key=lambda i: i.id)),
+                        self.ctx.get('shard_size', 1000),
+                        self.ctx.get('max_input_size', MAX_INPUT_SIZE))
+
+    def _collect_child_events(self, task):
+        for ev in _recent_events(task, self.ctx.get('_seen')):
+            if ev.type == 'StartChildWorkflowExecutionFailed':
+                workflow_id = ev.attrs['workflowId']
+            elif ev.type in _child_close_events:
+                workflow_id = ev.attrs['workflowExecution']['workflowId']
+            else:
+                continue
+            if workflow_id not in self.active:
+                continue
+            # Keys are strings to survive a JSON round-trip of the ctx
+            shard = str(self.active.pop(workflow_id))
+            if ev.type == 'ChildWorkflowExecutionCompleted':
+                self.done[shard] = ev.attrs.get('result')
+            else:
+                self.failed[shard] = (ev.type, ev.attrs)
+
+    def _start_children(self, task):
+        free = self.ctx.get('max_children', 10) - len(self.active)
+        if free <= 0 or self.ctx['_next'] == self.ctx['_count']:
+            return
+        workflow_type = eval_clspath(self.ctx['workflow_type'])
+        control = self.ctx.get('control')
+        shards = self._shards()
+        while free > 0 and self.ctx['_next'] < self.ctx['_count']:
+            shard = self.ctx['_next']
+            workflow_id = '%s-%s-%d' % (task.workflow_execution.workflow_id,
+                                        self.id, shard)
+            task.start_child(workflow_type, workflow_id, shards[shard],
+                             control=control)
+            self.active[workflow_id] = shard
+            self.ctx['_next'] = shard + 1
+            free -= 1
@@ -0,0 +1,137 @@
+"""Domain-wide concurrency limits per activity type.
+
+Before scheduling activities of a limited type, ``ActivityNode`` acquires a
+lease per activity from the flow's ``governor``. Activities that get no
+lease are deferred to a later decision task and leases are released when
+activities close or fail to be scheduled. Leases expire after ``lease_ttl``
+seconds (by default the activity type's ``schedule_to_close_timeout``, or
+``default_lease_ttl`` where that is ``'NONE'``), so a decider dying between
+acquiring and releasing cannot leak them.
+
+The leases live in a store shared by all deciders: ``SqliteLeaseStore`` for
+deciders on one host, or any object with the same ``acquire`` and
+``release`` methods.
+"""
+import sqlite3
+import threading
+import time
+
+__all__ = ['Governor', 'MemoryLeaseStore', 'SqliteLeaseStore']
+
+
+class Governor(object):
+
+    # Lease TTL of activity types without a schedule to close timeout
+    default_lease_ttl = 3600
+
+    def __init__(self, limits, store=None, lease_ttl=None):
+        """
+        :param limits: Dict of activity type name to maximum concurrency.
+                       Types not in it are not limited.
+        :param store: Lease store (default: ``MemoryLeaseStore``).
+        :param lease_ttl: Seconds until leases expire (optional).
+        """
+        self.limits = limits
+        self.store = store or MemoryLeaseStore()
+        self.lease_ttl = lease_ttl
+
+    def acquire(self, activity_type, leases):
+        """Acquire leases for activities of ``activity_type``.
+
+        :param leases: Lease ids, unique per activity.
+        :returns: The granted subset of ``leases``, in order.
+        """
+        limit = self.limits.get(activity_type.name)
+        if limit is None:
+            return list(leases)
+        return self.store.acquire(activity_type.name, leases, limit,
+                                  time.time() + self._ttl(activity_type))
+
+    def _ttl(self, activity_type):
+        if self.lease_ttl is not None:
+            return self.lease_ttl
+        timeout = activity_type.schedule_to_close_timeout
+        if timeout in (None, 'NONE'):
+            return self.default_lease_ttl
+        return float(timeout)
+
+    def release(self, activity_type, leases):
+        if activity_type.name in self.limits:
+            self.store.release(activity_type.name, leases)
+
+
+class MemoryLeaseStore(object):
+    """Leases within one process. """
+
+    def __init__(self):
+        self._leases = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, name, leases, limit, expires):
+        with self._lock:
+            now = time.time()
+            held = self._leases.setdefault(name, {})
+            for lease, lease_expires in held.items():
+                if lease_expires < now:
+                    del held[lease]
+            granted = []
+            for lease in leases:
+                if lease not in held and len(held) >= limit:
+                    continue
+                held[lease] = expires
+                granted.append(lease)
+            return granted
+
+    def release(self, name, leases):
+        with self._lock:
+            held = self._leases.get(name, {})
+            for lease in leases:
+                held.pop(lease, None)
+
+
+class SqliteLeaseStore(object):
+    """Leases in a sqlite database, shared by processes on a host. """
+
+    def __init__(self, path, timeout=30):
+        self._conn = sqlite3.connect(path, timeout=timeout,
+                                     isolation_level=None,
+                                     check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS leases ('
+                'name TEXT, lease TEXT, expires REAL, '
+                'PRIMARY KEY (name, lease))')
+
+    def acquire(self, name, leases, limit, expires):
+        with self._lock:
+            cursor = self._conn.cursor()
+            # Take the write lock up front so that counting and inserting
+            # are atomic across processes.
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                cursor.execute(
+                    'DELETE FROM leases WHERE name = ? AND expires < ?',
+                    (name, time.time()))
+                held = set(r[0] for r in cursor.execute(
+                    'SELECT lease FROM leases WHERE name = ?', (name,)))
+                granted = []
+                for lease in leases:
+                    if lease not in held and len(held) >= limit:
+                        continue
+                    held.add(lease)
+                    granted.append(lease)
+                cursor.executemany(
+                    'INSERT OR REPLACE INTO leases VALUES (?, ?, ?)',
+                    [(name, lease, expires) for lease in granted])
+            except Exception:
+                cursor.execute('ROLLBACK')
+                raise
+            cursor.execute('COMMIT')
+            return granted
+
+    def release(self, name, leases):
+        with self._lock:
+            self._conn.executemany(
+                'DELETE FROM leases WHERE name = ? AND lease = ?',
+                [(name, lease) for lease in leases])
@@ -0,0 +1,74 @@
+from flowser import serializing
+from .base import Node, SUCCEED, FAILED
+
+__all__ = ['local_activity', 'LocalActivityNode']
+
+# Largest marker details SWF accepts
+MAX_DETAILS_SIZE = 32768
+
+_functions = {}
+
+
+def local_activity(func=None, name=None):
+    """Register ``func`` for ``LocalActivityNode``. Usable as a decorator,
+    with or without arguments (``@local_activity(name='x')``).
+
+    :param name: Name to register under (default: the function's name).
+    """
+    if func is None:
+        return lambda func: local_activity(func, name)
+    _functions[name or func.__name__] = func
+    return func
+
+
+class LocalActivityNode(Node):
+    """Runs a registered function inside the decider.
+
+    The function named by ``function`` in ctx is called with the list of
+    upstream results (ordered by node id) and its result is recorded with a
+    RecordMarker decision. When the flow is decided again from history the
+    marker is read back instead of calling the function again, so the
+    function need not be deterministic. An exception, an unregistered
+    function or a result over the marker details limit (32kB serialized)
+    fails the node, with the reason in ctx ``error``.
+    """
+
+    @property
+    def marker_name(self):
+        return 'local:%s' % self.id
+
+    def decide(self, task):
+        details = self._recorded(task)
+        if details is None:
+            details = self._run()
+            data = serializing.dumps(details)
+            if len(data) > MAX_DETAILS_SIZE:
+                details = {'error': 'result is %d bytes serialized, over the '
+                                    '%d bytes of marker details' % (
+                                        len(data), MAX_DETAILS_SIZE)}
+                data = serializing.dumps(details)
+            task.mark(self.marker_name, data)
+        if 'error' in details:
+            self.ctx['error'] = details['error']
+            self.status = FAILED
+        else:
+            self.result = details['result']
+            self.status = SUCCEED
+
+    def _recorded(self, task):
+        for ev in task.filter('MarkerRecorded'):
+            if ev.attrs['markerName'] == self.marker_name:
+                return serializing.loads(ev.attrs['details'])
+        return None
+
+    def _run(self):
+        func = _functions.get(self.ctx['function'])
+        if func is None:
+            return {'error': 'no local activity registered as %r'
+                             % self.ctx['function']}
+        inputs = sorted(self.inputs, key=lambda i: i.id)
+        try:
+            return {'result': func([i.result for i in inputs
+                                    if i.result is not None])}
+        except Exception as e:
+            return {'error': '%s: %s' % (e.__class__.__name__, e)}
@@ -0,0 +1,141 @@
+from flowser import serializing
+from .base import SUCCEED, FAILED
+from .activitynode import ActivityNode
+
+# Largest input SWF accepts for an activity task
+MAX_INPUT_SIZE = 32768
+
+
+class MapNode(ActivityNode):
+    """Runs an activity over the upstream results in bounded batches.
+
+    Upstream results that are lists are concatenated into one list of
+    items, which is split into batches of at most ``batch_size`` items and
+    ``max_input_size`` serialized bytes. One activity is scheduled per
+    batch. The result is the concatenation of the activity results (which
+    should be lists) in batch order.
+
+    An item that alone is over ``max_input_size`` fails the node, with the
+    reason in ctx ``error``, instead of being scheduled.
+    """
+
+    def _batch_input(self):
+        return _batches(_items(_sorted(self.inputs)),
+                        self.ctx.get('batch_size', 100),
+                        self.ctx.get('max_input_size', MAX_INPUT_SIZE))
+
+    def _schedule(self, task):
+        _schedule_checked(self, task, self._batch_input(), self.id)
+
+    def _finish(self, task):
+        if 'error' in self.ctx:
+            self.status = FAILED
+            return
+        result = []
+        for _, (r, _) in sorted(self.done.iteritems(), key=_batch_index):
+            if isinstance(r, list):
+                result.extend(r)
+            elif r is not None:
+                result.append(r)
+        self.result = result
+        self.status = FAILED if self.failed else SUCCEED
+
+
+class TreeReduceNode(ActivityNode):
+    """Reduces the upstream results with an activity over log(n) levels.
+
+    Items are collected like in ``MapNode`` and split into batches of at most
+    ``fan_in`` items. Each activity combines a batch (a list) into a single
+    value. The values of a level are batched again for the next level until
+    a single value is left, which becomes the result. The combining activity
+    must therefore be associative and accept its own results as items; the
+    order of items within a batch is not preserved.
+
+    Like ``MapNode``, an item over ``max_input_size`` fails the node. So
+    does a level that batches no two values together (``fan_in`` of one,
+    or values too large to share a batch), since it would not reduce.
+    """
+
+    def _batch_input(self):
+        return _batches(_items(_sorted(self.inputs)),
+                        self.ctx.get('fan_in', 100),
+                        self.ctx.get('max_input_size', MAX_INPUT_SIZE))
+
+    def _schedule(self, task):
+        self.ctx['_level'] = 0
+        _schedule_checked(self, task, self._batch_input(), '%s-0' % self.id)
+
+    def _finish(self, task):
+        if self.failed or 'error' in self.ctx:
+            self.status = FAILED
+            return
+        values = [r for r, _ in self.done.itervalues() if r is not None]
+        if len(values) <= 1:
+            self.result = values[0] if values else None
+            self.status = SUCCEED
+            return
+        level = self.ctx['_level'] = self.ctx['_level'] + 1
+        self.done.clear()
+        batches = _batches(values, self.ctx.get('fan_in', 100),
+                           self.ctx.get('max_input_size', MAX_INPUT_SIZE))
+        if len(batches) >= len(values):
+            self.ctx['error'] = ('level %d does not reduce %d values, check '
+                                 'fan_in and max_input_size' % (level,
+                                                                len(values)))
+            self.status = FAILED
+            return
+        _schedule_checked(self, task, batches, '%s-%d' % (self.id, level))
+        if not (self.active or self.deferred):
+            # Every batch was a cache hit
+            self._finish(task)
+
+
+def _schedule_checked(node, task, batches, prefix):
+    """Schedule ``batches``, unless one is over the node's input size limit
+    (an item too large on its own), which sets ctx ``error`` instead. """
+    max_bytes = node.ctx.get('max_input_size', MAX_INPUT_SIZE)
+    for batch in batches:
+        size = len(serializing.dumps(batch))
+        if size > max_bytes:
+            node.ctx['error'] = ('batch of %d bytes serialized is over '
+                                 'max_input_size (%d)' % (size, max_bytes))
+            return
+    node._schedule_batches(task, batches, prefix)
+
+
+def _sorted(inputs):
+    # Inputs are a set; a fixed order keeps batches the same across
+    # decisions and processes.
+    return sorted(inputs, key=lambda i: i.id)
+
+
+def _items(inputs):
+    items = []
+    for i in inputs:
+        if isinstance(i.result, list):
+            items.extend(i.result)
+        elif i.result is not None:
+            items.append(i.result)
+    return items
+
+
+def _batches(items, size, max_bytes):
+    batches = []
+    batch = []
+    batch_bytes = 2
+    for item in items:
+        item_bytes = len(serializing.dumps(item)) + 2
+        if batch and (len(batch) == size or
+                      batch_bytes + item_bytes > max_bytes):
+            batches.append(batch)
+            batch = []
+            batch_bytes = 2
+        batch.append(item)
+        batch_bytes += item_bytes
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def _batch_index(item):
+    return int(item[0].rpartition('-')[2])
@@ -0,0 +1,139 @@
+"""Compiled flow plans.
+
+The graph shape of a flow usually does not change between decisions, only
+node state does. A ``Plan`` holds that shape in compact arrays: nodes in
+topological order, their classes, in-degrees and input/output adjacency.
+Plans are validated (no cycles) when compiled and cached per flow class and
+graph digest, so unfreezing a flow whose shape was seen before only needs to
+reattach node state. The cache keeps the ``MAX_PLANS`` most recently used
+plans, as shapes may vary per execution (e.g. fan-outs sized by input).
+"""
+import hashlib
+import threading
+from array import array
+from collections import OrderedDict
+
+from flowser.exceptions import Error
+
+__all__ = ['Plan', 'CycleError', 'plan_for']
+
+MAX_PLANS = 128
+
+_plans = OrderedDict()
+_plans_lock = threading.Lock()
+
+
+class CycleError(Error):
+    pass
+
+
+class Plan(object):
+
+    def __init__(self, ids, classes, outputs, digest):
+        """
+        :param ids: Node ids.
+        :param classes: Node classes, by node.
+        :param outputs: Output node indices, by node.
+        :param digest: Digest of the graph shape.
+        """
+        order = _toposort(outputs)
+        if order is None:
+            raise CycleError('flow graph has a cycle')
+        # Renumber nodes in topological order
+        position = dict((k, p) for p, k in enumerate(order))
+        self.digest = digest
+        self.ids = [ids[k] for k in order]
+        self.index = dict((nid, p) for p, nid in enumerate(self.ids))
+        self.classes = [classes[k] for k in order]
+        outputs = [sorted(position[j] for j in outputs[k]) for k in order]
+        inputs = [[] for _ in order]
+        for k, targets in enumerate(outputs):
+            for j in targets:
+                inputs[j].append(k)
+        self.indegree = array('i', [len(i) for i in inputs])
+        self._outputs = _csr(outputs)
+        self._inputs = _csr(inputs)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def outputs(self, k):
+        "Indices of the outputs of node ``k``. "
+        offsets, targets = self._outputs
+        return targets[offsets[k]:offsets[k + 1]]
+
+    def inputs(self, k):
+        "Indices of the inputs of node ``k``. "
+        offsets, targets = self._inputs
+        return targets[offsets[k]:offsets[k + 1]]
+
+    @classmethod
+    def compile(cls, state, classes):
+        """Compile the graph of a frozen flow.
+
+        :param classes: Resolved class table of ``state``.
+        :raises: CycleError
+        """
+        nodes = state['nodes']
+        ids = [n['id'] for n in nodes]
+        index = dict((nid, k) for k, nid in enumerate(ids))
+        outputs = [[index[o] for o in n['outputs']] for n in nodes]
+        return cls(ids, [classes[n['cls']] for n in nodes], outputs,
+                   _digest(state))
+
+
+def plan_for(state, classes):
+    """Cached plan for a frozen flow, compiled on first use.
+
+    A flow unfrozen with a plan carries its digest into the next ``freeze``,
+    so the digest need not be recomputed on a cache hit.
+    """
+    digest = state.get('plan')
+    if digest is not None:
+        with _plans_lock:
+            plan = _plans.pop((state['cls'], digest), None)
+            if plan is not None:
+                _plans[(state['cls'], digest)] = plan
+                return plan
+    plan = Plan.compile(state, classes)
+    with _plans_lock:
+        _plans[(state['cls'], plan.digest)] = plan
+        while len(_plans) > MAX_PLANS:
+            _plans.popitem(last=False)
+    return plan
+
+
+def _digest(state):
+    classes = state['classes']
+    lines = sorted('%s %s %s' % (n['id'], classes[n['cls']],
+                                 ','.join(sorted(n['outputs'])))
+                   for n in state['nodes'])
+    return hashlib.sha1('\n'.join(lines).encode('utf-8')).hexdigest()
+
+
+def _toposort(outputs):
+    indegree = [0] * len(outputs)
+    for targets in outputs:
+        for j in targets:
+            indegree[j] += 1
+    ready = [k for k, d in enumerate(indegree) if d == 0]
+    order = []
+    while ready:
+        k = ready.pop()
+        order.append(k)
+        for j in outputs[k]:
+            indegree[j] -= 1
+            if indegree[j] == 0:
+                ready.append(j)
+    if len(order) < len(outputs):
+        return None
+    return order
+
+
+def _csr(adjacency):
+    offsets = array('i', [0])
+    targets = array('i')
+    for row in adjacency:
+        targets.extend(row)
+        offsets.append(len(targets))
+    return offsets, targets
@@ -0,0 +1,188 @@
+"""Per-node profiling of flow decisions.
+
+Set a ``Profiler`` as the ``profiler`` of a flow (or flow class) to record,
+for each ``Node.decide`` call, the wall time, the history events the node
+inspected, the decisions it added and, with ``trace_memory``, the change in
+traced memory (only where ``tracemalloc`` is available). Status transitions
+are recorded too.
+
+``report`` summarizes a decision task with the slowest nodes first and
+``chrome_trace`` returns the spans in the Chrome trace event format, which
+chrome://tracing and Perfetto load.
+"""
+import json
+import time
+from contextlib import contextmanager
+
+from .base import INACTIVE, ACTIVE, SUCCEED, FAILED, CANCELED
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+__all__ = ['Profiler']
+
+_status_names = {
+    INACTIVE: 'INACTIVE',
+    ACTIVE: 'ACTIVE',
+    SUCCEED: 'SUCCEED',
+    FAILED: 'FAILED',
+    CANCELED: 'CANCELED',
+}
+
+
+class Profiler(object):
+
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory and tracemalloc is not None
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        # One dict per Flow.decide call, with the node spans in it
+        self.decisions = []
+        self._current = None
+        self._origin = time.time()
+
+    def _now(self):
+        return time.time() - self._origin
+
+    def _memory(self):
+        if self.trace_memory:
+            return tracemalloc.get_traced_memory()[0]
+        return 0
+
+    @contextmanager
+    def decision(self, task):
+        """Record a ``Flow.decide`` call. """
+        execution = getattr(task, 'workflow_execution', None)
+        self._current = {
+            'workflow_id': getattr(execution, 'workflow_id', None),
+            'started_event_id': getattr(task, 'started_event_id', None),
+            'start': self._now(),
+            'nodes': [],
+            'transitions': [],
+        }
+        try:
+            yield
+        finally:
+            current = self._current
+            current['seconds'] = self._now() - current['start']
+            self.decisions.append(current)
+            self._current = None
+
+    @contextmanager
+    def node(self, node, task):
+        """Record a ``Node.decide`` call. Yields the task to pass to it. """
+        proxy = _CountingTask(task)
+        decisions = len(task.decisions._data)
+        memory = self._memory()
+        start = self._now()
+        try:
+            yield proxy
+        finally:
+            span = {
+                'node': node.id,
+                'class': node.__class__.__name__,
+                'start': start,
+                'seconds': self._now() - start,
+                'events': proxy.events_inspected,
+                'decisions': len(task.decisions._data) - decisions,
+            }
+            if self.trace_memory:
+                span['memory'] = self._memory() - memory
+            if self._current is not None:
+                self._current['nodes'].append(span)
+
+    def transition(self, node, old, new):
+        """Record a node status change. """
+        if self._current is None:
+            return
+        self._current['transitions'].append({
+            'node': node.id,
+            'time': self._now(),
+            'from': _status_names.get(old, old),
+            'to': _status_names.get(new, new),
+        })
+
+    def report(self, index=-1, limit=20):
+        """Text report of one decision task, by default the last one. """
+        decision = self.decisions[index]
+        lines = ['decision %s (started event %s): %.3f ms, %d nodes, '
+                 '%d transitions' % (
+                     decision['workflow_id'], decision['started_event_id'],
+                     decision['seconds'] * 1000, len(decision['nodes']),
+                     len(decision['transitions']))]
+        header = '%-30s %-20s %10s %8s %10s' % (
+                'node', 'class', 'ms', 'events', 'decisions')
+        if self.trace_memory:
+            header += ' %12s' % 'memory'
+        lines.append(header)
+        spans = sorted(decision['nodes'], key=lambda s: -s['seconds'])
+        for span in spans[:limit]:
+            line = '%-30s %-20s %10.3f %8d %10d' % (
+                    span['node'], span['class'], span['seconds'] * 1000,
+                    span['events'], span['decisions'])
+            if self.trace_memory:
+                line += ' %12d' % span['memory']
+            lines.append(line)
+        if len(spans) > limit:
+            lines.append('... %d more' % (len(spans) - limit))
+        return '\n'.join(lines)
+
+    def chrome_trace(self):
+        """Spans in the Chrome trace event format, as a dict. """
+        events = []
+        us = lambda seconds: int(seconds * 1e6)
+        for tid, decision in enumerate(self.decisions):
+            events.append({
+                'name': 'decide %s' % decision['workflow_id'],
+                'cat': 'flow', 'ph': 'X', 'pid': 0, 'tid': tid,
+                'ts': us(decision['start']), 'dur': us(decision['seconds']),
+                'args': {'started_event_id': decision['started_event_id']},
+            })
+            for span in decision['nodes']:
+                args = dict((k, span[k]) for k in ('events', 'decisions',
+                                                   'memory') if k in span)
+                events.append({
+                    'name': span['node'], 'cat': span['class'], 'ph': 'X',
+                    'pid': 0, 'tid': tid, 'ts': us(span['start']),
+                    'dur': us(span['seconds']), 'args': args,
+                })
+            for transition in decision['transitions']:
+                events.append({
+                    'name': '%s %s' % (transition['node'], transition['to']),
+                    'cat': 'status', 'ph': 'i', 's': 't', 'pid': 0,
+                    'tid': tid, 'ts': us(transition['time']),
+                    'args': {'from': transition['from']},
+                })
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def write_trace(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.chrome_trace(), f)
+
+
+class _CountingTask(object):
+    """Decision task proxy counting the history events iterated over. """
+
+    def __init__(self, task):
+        self._task = task
+        self.events_inspected = 0
+
+    def __getattr__(self, name):
+        return getattr(self._task, name)
+
+    @property
+    def events(self):
+        for ev in self._task.events:
+            self.events_inspected += 1
+            yield ev
+
+    def most_recent(self, event_type):
+        for ev in self.events:
+            if ev.type == event_type:
+                return ev
+        return None
+
+    def filter(self, event_type):
+        return [ev for ev in self.events if ev.type == event_type]
@@ -0,0 +1,100 @@
+"""Delta snapshots of flows.
+
+A full snapshot (``freeze``) is taken once; after that only the nodes that
+changed since the previous snapshot (``Flow.dirty``) are frozen into deltas.
+The deltas are folded back into a new full snapshot every ``compact_every``
+snapshots so loading never replays a long chain.
+"""
+from flowser.exceptions import Error
+from .utils import freeze, unfreeze
+
+__all__ = ['freeze_delta', 'apply_delta', 'Snapshots']
+
+
+def freeze_delta(flow):
+    """Frozen state of the nodes in ``flow.dirty``. Clears ``flow.dirty``. """
+    delta = freeze(flow, [flow.nodes[nid] for nid in flow.dirty])
+    delta['delta'] = True
+    flow.dirty.clear()
+    return delta
+
+
+def apply_delta(state, delta):
+    """New full state from a full ``state`` and a later ``delta``. """
+    classes = list(state['classes'])
+    clsids = dict((path, idx) for idx, path in enumerate(classes))
+    nodes = dict((n['id'], n) for n in state['nodes'])
+    for nodestate in delta['nodes']:
+        path = delta['classes'][nodestate['cls']]
+        if path not in clsids:
+            clsids[path] = len(classes)
+            classes.append(path)
+        nodes[nodestate['id']] = dict(nodestate, cls=clsids[path])
+    state = {
+        'cls': delta['cls'],
+        'idx': delta['idx'],
+        'props': delta['props'],
+        'nodes': nodes.values(),
+        'classes': classes,
+    }
+    if 'plan' in delta:
+        # Digest of the whole graph at the time of the delta
+        state['plan'] = delta['plan']
+    return state
+
+
+class Snapshots(object):
+    """A base snapshot and the deltas taken after it.
+
+    ``save`` returns the record to persist: either a delta, to append to
+    what is stored, or a full snapshot (``record['delta']`` is false), which
+    replaces everything stored before it. Loading all stored records back in
+    order with ``Snapshots.from_records`` restores the flow.
+    """
+
+    def __init__(self, compact_every=20):
+        self.compact_every = compact_every
+        self.base = None
+        self.deltas = []
+
+    @classmethod
+    def from_records(cls, records, compact_every=20):
+        snapshots = cls(compact_every)
+        for record in records:
+            if record.get('delta'):
+                if snapshots.base is None:
+                    raise Error('delta without a base snapshot')
+                snapshots.deltas.append(record)
+            else:
+                snapshots.base = record
+                snapshots.deltas = []
+        return snapshots
+
+    def save(self, flow):
+        """Snapshot ``flow`` and return the record to persist. """
+        if self.base is None or len(self.deltas) + 1 >= self.compact_every:
+            self.base = freeze(flow)
+            self.base['delta'] = False
+            self.deltas = []
+            flow.dirty.clear()
+            return self.base
+        delta = freeze_delta(flow)
+        self.deltas.append(delta)
+        return delta
+
+    def state(self):
+        """Full frozen state of the latest snapshot. """
+        state = self.base
+        for delta in self.deltas:
+            state = apply_delta(state, delta)
+        return state
+
+    def compact(self):
+        """Fold the deltas into the base snapshot. """
+        self.base = dict(self.state(), delta=False)
+        self.deltas = []
+        return self.base
+
+    def load(self):
+        """Unfreeze the latest snapshot. """
+        return unfreeze(self.state())
@@ -1,39 +1,95 @@
 import logging
 
+from .plan import plan_for
+
 __all__ = ['freeze', 'unfreeze', 'get_clspath', 'eval_clspath']
 
 logger = logging.getLogger('flowser.flow.utils')
 
+# Class path <-> class caches. Classes are assumed not to be redefined.
+_clspaths = {}
+_classes = {}
+
 def get_clspath(o):
-    return '%s.%s' % (o.__class__.__module__, o.__class__.__name__)
+    cls = o.__class__
+    try:
+        return _clspaths[cls]
+    except KeyError:
+        clspath = _clspaths[cls] = '%s.%s' % (cls.__module__, cls.__name__)
+        return clspath
 
 def eval_clspath(clspath):
-    modulepath, _, clsname = clspath.rpartition('.')
-    module = __import__(modulepath, fromlist=[clsname])
-    return getattr(module, clsname)
+    try:
+        return _classes[clspath]
+    except KeyError:
+        modulepath, _, clsname = clspath.rpartition('.')
+        module = __import__(modulepath, fromlist=[clsname])
+        cls = _classes[clspath] = getattr(module, clsname)
+        return cls
+
+def freeze(flow, nodes=None):
+    """Frozen state of ``flow``, restricted to ``nodes`` if given. """
+    if nodes is None:
+        nodes = flow.nodes.itervalues()
+    # Node classes are written once to a class table and referenced by index.
+    classes = []
+    clsids = {}
+    def _clsid(node):
+        cls = node.__class__
+        if cls not in clsids:
+            clsids[cls] = len(classes)
+            classes.append(get_clspath(node))
+        return clsids[cls]
 
-def freeze(flow):
     _nfreeze = lambda node:{
         'id': node.id,
-        'cls': get_clspath(node),
+        'cls': _clsid(node),
         'inputs': [i.id for i in node.inputs],
         'outputs': [o.id for o in node.outputs],
         'status': node.status,
         'result': node.result,
-        'ctx': node.ctx,
+        'ctx': node._ctx,
     }
-    return {
+    state = {
         'cls': get_clspath(flow),
         'idx': flow.idx,
         'props': flow.props,
-        'nodes': [_nfreeze(n) for n in flow.nodes.itervalues()],
+        'nodes': [_nfreeze(n) for n in nodes],
+        'classes': classes,
     }
+    if flow._plan is not None:
+        state['plan'] = flow._plan.digest
+    return state
 
 
 def unfreeze(state):
     cls = eval_clspath(state['cls'])
     flow = cls(props=state['props'])
     flow.idx = state['idx']
+    if 'classes' not in state:
+        # Snapshot from before class tables
+        return _unfreeze_connect(flow, state)
+
+    classes = [eval_clspath(p) for p in state['classes']]
+    plan = plan_for(state, classes)
+    nodes = [None] * len(plan)
+    for nodestate in state['nodes']:
+        k = plan.index[nodestate['id']]
+        node = plan.classes[k](flow, id=nodestate['id'])
+        node._ctx = nodestate['ctx']
+        node._result = nodestate['result']
+        nodes[k] = node
+
+    for k, node in enumerate(nodes):
+        node.inputs = set(nodes[j] for j in plan.inputs(k))
+        node.outputs = set(nodes[j] for j in plan.outputs(k))
+
+    flow._plan = plan
+    flow.dirty.clear()
+    return flow
+
+
+def _unfreeze_connect(flow, state):
     # Unfreeze, register and collect connection between nodes
     connections = []
     for nodestate in state['nodes']:
@@ -49,4 +105,5 @@ def unfreeze(state):
             output = flow.nodes[oid]
             node.connect(output)
 
+    flow.dirty.clear()
     return flow
@@ -0,0 +1,221 @@
+# Copyright (c) 2012 Memoto AB
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""Metrics.
+
+flowser reports measurements through a pluggable sink, which does nothing
+by default. Install one with ``configure``::
+
+    from flowser import metrics
+    metrics.configure(metrics.StatsdSink('127.0.0.1', 8125))
+
+Reported metrics (all names prefixed by the sink):
+
+* ``poll.seconds`` (task_list): long poll latency.
+* ``poll.empty`` (task_list): polls returning no task.
+* ``handler.seconds`` (type): time spent handling a polled task.
+* ``history.pages``, ``history.events``, ``history.page_seconds``: history
+  pages fetched by ``tasks.Decision``.
+* ``decision.decisions``: decisions per decision task response.
+* ``payload.bytes`` (op): sizes of payloads serialized and unserialized.
+
+Errors of the sink are logged, never raised into the code reporting.
+"""
+import logging
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger('flowser.metrics')
+
+
+class Sink(object):
+    """Metrics sink doing nothing. Base class for sinks. """
+
+    def incr(self, name, value=1, tags=None):
+        "Add ``value`` to a counter. "
+
+    def observe(self, name, value, tags=None):
+        "Record a value of a distribution (durations in seconds, sizes). "
+
+
+_sink = Sink()
+
+
+def configure(sink):
+    """Install ``sink`` and return the previous one. """
+    global _sink
+    previous, _sink = _sink, sink
+    return previous
+
+
+def incr(name, value=1, tags=None):
+    try:
+        _sink.incr(name, value, tags)
+    except Exception:
+        logger.exception("metrics sink failed")
+
+
+def observe(name, value, tags=None):
+    try:
+        _sink.observe(name, value, tags)
+    except Exception:
+        logger.exception("metrics sink failed")
+
+
+@contextmanager
+def timed(name, tags=None):
+    "Observe the duration of the block in seconds. "
+    start = time.time()
+    try:
+        yield
+    finally:
+        observe(name, time.time() - start, tags)
+
+
+def _key(name, tags):
+    return name, tuple(sorted((tags or {}).items()))
+
+
+class PrometheusTextFile(Sink):
+    """Writes metrics in Prometheus text format to a file, e.g. for the node
+    exporter's textfile collector.
+
+    Counters become ``<prefix>_<name>_total`` and distributions summaries
+    with ``_count`` and ``_sum``. The file is rewritten by ``flush``, which
+    also happens when recording a metric ``flush_interval`` seconds after the
+    previous flush.
+    """
+
+    def __init__(self, path, prefix='flowser', flush_interval=10):
+        self.path = path
+        self.prefix = prefix
+        self.flush_interval = flush_interval
+        self._counters = {}
+        self._summaries = {}
+        self._flushed = time.time()
+        self._lock = threading.Lock()
+        # Flushes of all threads share the tmp file
+        self._flush_lock = threading.Lock()
+
+    def incr(self, name, value=1, tags=None):
+        key = _key(name, tags)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+        self._maybe_flush()
+
+    def observe(self, name, value, tags=None):
+        key = _key(name, tags)
+        with self._lock:
+            count, total = self._summaries.get(key, (0, 0))
+            self._summaries[key] = (count + 1, total + value)
+        self._maybe_flush()
+
+    def _maybe_flush(self):
+        if time.time() - self._flushed < self.flush_interval:
+            return
+        # One thread flushes, the others go on recording.
+        if not self._flush_lock.acquire(False):
+            return
+        try:
+            if time.time() - self._flushed >= self.flush_interval:
+                self._flush()
+        finally:
+            self._flush_lock.release()
+
+    def _name(self, name):
+        return '%s_%s' % (self.prefix, name.replace('.', '_'))
+
+    def _labels(self, tags):
+        if not tags:
+            return ''
+        return '{%s}' % ','.join(
+                '%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                for k, v in tags)
+
+    def render(self):
+        with self._lock:
+            counters = sorted(self._counters.items())
+            summaries = sorted(self._summaries.items())
+        lines = []
+        for (name, tags), value in counters:
+            lines.append('%s_total%s %s' % (
+                    self._name(name), self._labels(tags), value))
+        for (name, tags), (count, total) in summaries:
+            labels = self._labels(tags)
+            lines.append('%s_count%s %s' % (self._name(name), labels, count))
+            lines.append('%s_sum%s %s' % (self._name(name), labels, total))
+        return '\n'.join(lines) + '\n'
+
+    def flush(self):
+        with self._flush_lock:
+            self._flush()
+
+    def _flush(self):
+        self._flushed = time.time()
+        tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            f.write(self.render())
+        os.rename(tmp_path, self.path)
+
+
+class StatsdSink(Sink):
+    """Sends metrics to statsd over UDP.
+
+    Counters are sent as ``c`` and distributions as ``ms`` (durations,
+    converted from seconds) or ``h``. Tag values are appended to the metric
+    name, or sent as DogStatsD tags if ``dogstatsd`` is set.
+    """
+
+    def __init__(self, host='127.0.0.1', port=8125, prefix='flowser',
+                 dogstatsd=False):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.dogstatsd = dogstatsd
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def incr(self, name, value=1, tags=None):
+        self._send(name, value, 'c', tags)
+
+    def observe(self, name, value, tags=None):
+        if name.endswith('.seconds'):
+            self._send(name[:-len('.seconds')], value * 1000, 'ms', tags)
+        else:
+            self._send(name, value, 'h', tags)
+
+    def _send(self, name, value, kind, tags):
+        name = '%s.%s' % (self.prefix, name)
+        suffix = ''
+        if tags and self.dogstatsd:
+            suffix = '|#' + ','.join('%s:%s' % t for t in sorted(tags.items()))
+        elif tags:
+            name += ''.join('.%s' % _clean(v) for _, v in sorted(tags.items()))
+        try:
+            self._socket.sendto('%s:%s|%s%s' % (name, value, kind, suffix),
+                                self.address)
+        except socket.error:
+            pass
+
+
+def _clean(value):
+    return ''.join(c if c.isalnum() or c in '-_' else '_' for c in str(value))
@@ -0,0 +1,422 @@
+# Copyright (c) 2012 Memoto AB
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""Polling.
+
+Long polls against a task list are kept busy by a pool of poller threads
+whose size follows the empty-poll ratio of the list: a list where polls keep
+coming back with tasks gets more concurrent pollers (up to a bound) and a
+list where polls keep coming back empty gets fewer.
+
+``Multiplexer`` serves many types, spread over many task lists, from one
+worker by sharing a few poll slots between the lists.
+"""
+import logging
+import threading
+import time
+from collections import deque
+from Queue import Queue, Empty, Full
+
+from flowser import metrics
+from flowser import tasks
+from flowser import types
+from flowser.exceptions import Error
+from flowser.exceptions import EmptyTaskPollResult
+
+logger = logging.getLogger('flowser.polling')
+
+
+class PollStats(object):
+    """Poll outcomes for a single task list.
+
+    Keeps running totals and a sliding window over the most recent polls,
+    from which the empty-poll ratio and the task arrival rate are computed.
+    """
+
+    def __init__(self, window=10):
+        self.window = window
+        self.polls = 0
+        self.empty_polls = 0
+        self._outcomes = deque(maxlen=window)
+        self._arrivals = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, got_task):
+        "Record the outcome of one poll. "
+        with self._lock:
+            self.polls += 1
+            self._outcomes.append(bool(got_task))
+            if got_task:
+                self._arrivals.append(time.time())
+            else:
+                self.empty_polls += 1
+
+    def reset_window(self):
+        "Forget the sliding window (totals are kept). "
+        with self._lock:
+            self._outcomes.clear()
+            self._arrivals.clear()
+
+    @property
+    def window_full(self):
+        return len(self._outcomes) == self.window
+
+    @property
+    def empty_ratio(self):
+        "Ratio of empty polls within the window. "
+        with self._lock:
+            if not self._outcomes:
+                return 0.0
+            return 1.0 - sum(self._outcomes) / float(len(self._outcomes))
+
+    @property
+    def arrival_rate(self):
+        "Tasks per second over the window. "
+        with self._lock:
+            if len(self._arrivals) < 2:
+                return 0.0
+            span = self._arrivals[-1] - self._arrivals[0]
+            return (len(self._arrivals) - 1) / max(span, 1e-3)
+
+    def __repr__(self):
+        return "<PollStats polls(%d) empty_ratio(%.2f) arrival_rate(%.2f)>" % (
+                self.polls, self.empty_ratio, self.arrival_rate)
+
+
+class AdaptivePoller(object):
+    """Runs between ``min_pollers`` and ``max_pollers`` concurrent long polls.
+
+    Iterating over the poller yields poll results as they arrive. Pollers
+    only start a poll while more consumers wait for a result than there are
+    results queued and polls in flight, since a polled task's start to
+    close timeout runs while it waits to be handled. Every time the sliding
+    window in ``stats`` fills up, the number of pollers is adjusted: one
+    more poller when the empty ratio is at most ``grow_below``, tasks
+    arrive at ``busy_rate`` per second and poller or more, and a consumer
+    is waiting; one less when the empty ratio is at least ``shrink_above``.
+
+    Exceptions other than ``EmptyTaskPollResult`` are re-raised in the
+    consuming thread.
+    """
+
+    def __init__(self, poll, min_pollers=1, max_pollers=4, stats=None,
+                 grow_below=0.1, shrink_above=0.5, busy_rate=1.0):
+        """
+        :param poll: Callable returning a poll result or raising
+                     ``EmptyTaskPollResult``.
+        :param stats: A ``PollStats`` instance (optional).
+        """
+        assert 1 <= min_pollers <= max_pollers, "bad poller bounds"
+        self._poll = poll
+        self.min_pollers = min_pollers
+        self.max_pollers = max_pollers
+        self.stats = stats or PollStats()
+        self.grow_below = grow_below
+        self.shrink_above = shrink_above
+        self.busy_rate = busy_rate
+        self.target = min_pollers
+        self._running = 0
+        self._results = Queue(maxsize=max_pollers)
+        self._lock = threading.Lock()
+        # Consumers waiting for a result and polls in flight, guarded by
+        # _demand
+        self._idle = 0
+        self._in_flight = 0
+        self._demand = threading.Condition()
+        self._stopped = threading.Event()
+        self._threads = []
+
+    def __iter__(self):
+        self.start()
+        try:
+            while True:
+                result, exc = self._get()
+                if exc is not None:
+                    raise exc
+                yield result
+        finally:
+            self.stop()
+
+    def _get(self):
+        with self._demand:
+            self._idle += 1
+            self._demand.notify_all()
+        try:
+            while True:
+                try:
+                    return self._results.get(timeout=1)
+                except Empty:
+                    continue
+        finally:
+            with self._demand:
+                self._idle -= 1
+
+    def start(self):
+        self._stopped.clear()
+        self._spawn()
+
+    def stop(self):
+        self._stopped.set()
+        with self._demand:
+            self._demand.notify_all()
+
+    def join(self, timeout=None):
+        "Wait for poller threads to finish after ``stop``. "
+        for thread in list(self._threads):
+            thread.join(timeout)
+
+    def _spawn(self):
+        with self._lock:
+            while self._running < self.target:
+                self._running += 1
+                thread = threading.Thread(target=self._run)
+                thread.daemon = True
+                thread.start()
+                self._threads = [t for t in self._threads if t.is_alive()]
+                self._threads.append(thread)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            with self._lock:
+                if self._running > self.target:
+                    self._running -= 1
+                    return
+            if not self._wait_for_demand():
+                break
+            try:
+                result = self._poll()
+            except EmptyTaskPollResult:
+                self.stats.record(False)
+            except Exception as e:
+                self._put((None, e))
+            else:
+                self.stats.record(True)
+                self._put((result, None))
+            finally:
+                with self._demand:
+                    self._in_flight -= 1
+                    self._demand.notify_all()
+            self._rescale()
+        with self._lock:
+            self._running -= 1
+
+    def _wait_for_demand(self):
+        """Wait until a consumer is left without a queued result or a poll
+        in flight, and count the poll about to start. """
+        with self._demand:
+            while self._idle <= self._results.qsize() + self._in_flight:
+                if self._stopped.is_set():
+                    return False
+                self._demand.wait(1)
+            if self._stopped.is_set():
+                return False
+            self._in_flight += 1
+            return True
+
+    def _put(self, item):
+        while not self._stopped.is_set():
+            try:
+                self._results.put(item, timeout=1)
+                return
+            except Full:
+                continue
+
+    def _rescale(self):
+        if not self.stats.window_full:
+            return
+        ratio = self.stats.empty_ratio
+        busy = self.stats.arrival_rate >= self.target * self.busy_rate
+        with self._lock:
+            old = self.target
+            if ratio <= self.grow_below and busy and \
+                    self.target < self.max_pollers and self._idle:
+                self.target += 1
+            elif ratio >= self.shrink_above and self.target > self.min_pollers:
+                self.target -= 1
+            if self.target == old:
+                return
+        logger.debug("pollers %d -> %d (%r)", old, self.target, self.stats)
+        self.stats.reset_window()
+        self._spawn()
+
+
+class _TaskList(object):
+    """A task list served by a ``Multiplexer``. """
+
+    def __init__(self, instance, kind, stats):
+        self.instance = instance
+        self.kind = kind
+        self.stats = stats
+        self.weight = 0
+        self.current = 0
+        self.handlers = {}
+
+    @property
+    def effective_weight(self):
+        # Lists that keep polling empty get a smaller share of the slots,
+        # but never none at all.
+        return self.weight * max(1.0 - self.stats.empty_ratio, 0.1)
+
+    def poll(self):
+        if self.kind == 'decision':
+            return self.instance._poll_for_decision_task(reverse_order=True)
+        return self.instance._poll_for_activity_task()
+
+    def type_name(self, result):
+        if self.kind == 'decision':
+            return result['workflowType']['name']
+        return result['activityType']['name']
+
+    def task_class(self):
+        if self.kind == 'decision':
+            return tasks.Decision
+        return tasks.Activity
+
+
+class Multiplexer(object):
+    """Serves many types from a fixed number of poll slots.
+
+    Types are registered together with a handler, which is called with each
+    task (``tasks.Decision`` or ``tasks.Activity``) of that type. Every shard
+    of a sharded type is served as a task list of its own. Types may share a
+    task list; tasks are dispatched on the workflow or activity type
+    name in the poll result.
+
+    Each of the ``concurrency`` slots repeatedly picks a task list using
+    smooth weighted round-robin and long polls it. A list's weight is the
+    largest weight it was registered with, scaled down by its empty-poll
+    ratio. Since an empty long poll occupies its slot for up to a minute,
+    ``concurrency`` should not be much lower than the number of busy lists.
+
+    Example::
+
+        mux = Multiplexer(domain, concurrency=2)
+        mux.register(MultiplyActivity, handle_multiply, weight=3)
+        mux.register(SumActivity, handle_sum)
+        mux.serve()
+    """
+
+    def __init__(self, domain, concurrency=1):
+        """
+        :param domain: A ``domain.Domain`` instance.
+        :param concurrency: Number of concurrent long polls.
+        """
+        self._domain = domain
+        self.concurrency = concurrency
+        self._lists = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._threads = []
+
+    def register(self, t, handler, weight=1):
+        """Serve tasks of type ``t`` with ``handler``.
+
+        :param t: Subclass of ``types.Workflow`` or ``types.Activity``.
+        :param handler: Callable taking a task.
+        :param weight: Relative share of poll slots for the task list.
+        """
+        kind = 'decision' if issubclass(t, types.Workflow) else 'activity'
+        for instance in t(self._domain)._shard_instances():
+            key = (kind, instance.task_list)
+            if key not in self._lists:
+                stats = self._domain._stats_for(kind,
+                                                instance.task_list)
+                self._lists[key] = _TaskList(instance, kind, stats)
+            task_list = self._lists[key]
+            if instance.name in task_list.handlers:
+                raise Error("%s already registered" % instance.name)
+            task_list.handlers[instance.name] = (instance, handler)
+            task_list.weight = max(task_list.weight, weight)
+        return self
+
+    def serve(self):
+        """Poll and dispatch until ``stop`` is called. """
+        assert self._lists, "no types registered"
+        self._stopped.clear()
+        self._threads = []
+        for _ in range(self.concurrency):
+            thread = threading.Thread(target=self._run)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        while any(t.is_alive() for t in self._threads):
+            for thread in self._threads:
+                thread.join(1)
+
+    def stop(self):
+        """Stop serving once the polls in flight return. """
+        self._stopped.set()
+
+    def _next(self):
+        with self._lock:
+            total = 0.0
+            best = None
+            for task_list in self._lists.values():
+                weight = task_list.effective_weight
+                task_list.current += weight
+                total += weight
+                if best is None or task_list.current > best.current:
+                    best = task_list
+            best.current -= total
+            return best
+
+    def _run(self):
+        while not self._stopped.is_set():
+            task_list = self._next()
+            tags = {'task_list': task_list.instance.task_list}
+            try:
+                with metrics.timed('poll.seconds', tags):
+                    result = task_list.poll()
+            except EmptyTaskPollResult:
+                metrics.incr('poll.empty', tags=tags)
+                task_list.stats.record(False)
+                continue
+            except Exception:
+                logger.exception("poll failed")
+                time.sleep(1)
+                continue
+            task_list.stats.record(True)
+            try:
+                self._dispatch(task_list, result)
+            except Exception:
+                # A slot must outlive any task
+                logger.exception("dispatch failed")
+
+    def _dispatch(self, task_list, result):
+        name = task_list.type_name(result)
+        task_class = task_list.task_class()
+        try:
+            instance, handler = task_list.handlers[name]
+        except KeyError:
+            logger.error("no handler for %s on %s", name,
+                         task_list.instance.task_list)
+            if task_list.kind == 'decision':
+                # SWF cannot fail decision tasks; it times out and is
+                # scheduled again, for a decider that knows the type.
+                return
+            task = task_class(result, task_list.instance)
+            task.fail(reason='no handler for %s' % name)
+            return
+        try:
+            with metrics.timed('handler.seconds', {'type': name}):
+                handler(task_class(result, instance))
+        except Exception:
+            logger.exception("handler for %s failed", name)
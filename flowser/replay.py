@@ -0,0 +1,253 @@
+# Copyright (c) 2012 Memoto AB
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""Recording and replaying decision tasks.
+
+``Recorder`` writes decision tasks to a gzip compressed file of JSON lines,
+one line (and gzip member) per task: the ``PollForDecisionTask`` result
+with the events of all pages merged, and the decisions made for it. Wrap
+the decision tasks of a decider to record them::
+
+    recorder = Recorder('decisions-%s.jsonl.gz' % date)
+    for task in recorder.wrap(domain.decisions(MyWorkflow)):
+        decide(task)
+
+``replay`` feeds recorded tasks through ``tasks.Decision`` and a decide
+function (e.g. one calling ``Flow.decide``) without calling SWF, as fast as
+possible. It reports the decision tasks per second and the tasks for which
+the decisions differ from the recorded ones, which means either a change
+of behaviour or a nondeterministic decider.
+"""
+import copy
+import gzip
+import json
+import logging
+import time
+import zlib
+
+from flowser import tasks
+
+__all__ = ['Recorder', 'read', 'replay', 'ReplayResult']
+
+logger = logging.getLogger('flowser.replay')
+
+
+class Recorder(object):
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'ab')
+        self.count = 0
+
+    def snapshot(self, task):
+        """Poll result of ``task`` with all history pages.
+
+        Remaining pages are fetched now, before the decider looks at the
+        events (which unserializes some attributes in place).
+        """
+        while task.next_page_token is not None:
+            task._next_page()
+        return {
+            'events': copy.deepcopy(task._events),
+            'previousStartedEventId': task.previous_started_event_id,
+            'startedEventId': task.started_event_id,
+            'taskToken': task.task_token,
+            'workflowExecution': {
+                'workflowId': task.workflow_execution.workflow_id,
+                'runId': task.workflow_execution.run_id,
+            },
+            'workflowType': {
+                'name': task.workflow_type.name,
+                'version': task.workflow_type.version,
+            },
+        }
+
+    def write(self, result, decisions=None):
+        record = {'result': result, 'decisions': decisions,
+                  'recorded_at': time.time()}
+        # Each record is a gzip member of its own, so that the records
+        # written survive an interrupted run.
+        member = gzip.GzipFile(fileobj=self._file, mode='wb')
+        member.write(json.dumps(record) + '\n')
+        member.close()
+        self._file.flush()
+        self.count += 1
+
+    def wrap(self, decision_tasks):
+        """Record the tasks of ``decision_tasks`` as they are handled.
+
+        A task is written with its decisions as soon as it is completed or
+        failed, otherwise when the next task is asked for or the generator
+        is closed. The file is closed with the generator.
+        """
+        pending = []
+
+        def write_pending():
+            while pending:
+                task, result = pending.pop()
+                self.write(result, task.decisions._data)
+
+        def respond(method):
+            def wrapper(*args, **kwargs):
+                try:
+                    return method(*args, **kwargs)
+                finally:
+                    write_pending()
+            return wrapper
+
+        try:
+            for task in decision_tasks:
+                pending.append((task, self.snapshot(task)))
+                task.complete = respond(task.complete)
+                task.fail = respond(task.fail)
+                yield task
+                write_pending()
+        finally:
+            write_pending()
+            self.close()
+
+    def close(self):
+        self._file.close()
+
+
+def read(path):
+    """Generate the records of a recording.
+
+    A record cut short at the end, e.g. by killing the recording process,
+    is skipped.
+    """
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    buf = ''
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(65536)
+            if not data:
+                break
+            while data:
+                try:
+                    buf += decompressor.decompress(data)
+                except zlib.error:
+                    logger.warning("corrupt data in %s", path)
+                    return
+                # Data past the end of a gzip member starts the next one.
+                data = decompressor.unused_data
+                if data:
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            lines = buf.split('\n')
+            buf = lines.pop()
+            for line in lines:
+                yield json.loads(line)
+    if buf:
+        logger.warning("skipping truncated record at the end of %s", path)
+
+
+class ReplayResult(object):
+
+    def __init__(self):
+        self.tasks = 0
+        self.decisions = 0
+        # Seconds spent in the decide function
+        self.seconds = 0.0
+        # (record, replayed decisions) of tasks not decided as recorded
+        self.mismatches = []
+        # (record, exception) of tasks the decide function failed on
+        self.errors = []
+
+    @property
+    def tasks_per_second(self):
+        if not self.seconds:
+            return 0.0
+        return self.tasks / self.seconds
+
+    def __repr__(self):
+        return ("<ReplayResult tasks(%d) decisions(%d) %.1f tasks/s "
+                "mismatches(%d) errors(%d)>" % (
+                    self.tasks, self.decisions, self.tasks_per_second,
+                    len(self.mismatches), len(self.errors)))
+
+
+def replay(path, domain, decide, passes=1):
+    """Replay a recording.
+
+    Each recorded task is decided ``passes`` times. Decisions are compared
+    with the recorded ones, or with those of the first pass if none were
+    recorded, so that ``passes=2`` finds nondeterminism in any recording.
+
+    :param path: Recording written by ``Recorder``.
+    :param domain: Domain whose ``workflow_types`` the recorded tasks are
+                   of. Its connection is replaced by a stub, so responses
+                   of the decide function never reach SWF.
+    :param decide: Callable taking a ``tasks.Decision``.
+    :returns: ``ReplayResult``.
+    """
+    domain = copy.copy(domain)
+    domain.conn = _ReplayConnection()
+    workflow_types = dict((t.name, t) for t in domain.workflow_types or [])
+    callers = {}
+    result = ReplayResult()
+    for record in read(path):
+        name = record['result']['workflowType']['name']
+        if name not in callers:
+            callers[name] = workflow_types[name](domain)
+        expected = record.get('decisions')
+        for _ in range(passes):
+            # Decide on a copy, the events get unserialized in place.
+            task = tasks.Decision(copy.deepcopy(record['result']),
+                                  callers[name])
+            # Deadlines of the original task do not apply.
+            task.timeout = None
+            start = time.time()
+            try:
+                decide(task)
+            except Exception as e:
+                logger.exception("replay of %s failed", task)
+                result.errors.append((record, e))
+                break
+            finally:
+                result.seconds += time.time() - start
+            decisions = _normalized(task.decisions._data)
+            result.tasks += 1
+            result.decisions += len(decisions)
+            if expected is None:
+                expected = decisions
+            elif _normalized(expected) != decisions:
+                result.mismatches.append((record, decisions))
+    return result
+
+
+class _ReplayConnection(object):
+    """Connection stub recording calls instead of making them. """
+
+    def __init__(self):
+        self.calls = []
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def call(*args, **kwargs):
+            self.calls.append((name, args, kwargs))
+            return {}
+        return call
+
+
+def _normalized(decisions):
+    return json.loads(json.dumps(decisions, sort_keys=True))
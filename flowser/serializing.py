@@ -23,9 +23,20 @@
 The purpose is to serialize and unserialize inputs and outputs to and from
 workflows and tasks.
 
-Now, this is just a facade for the standard `json` module.
+Now, this is just a facade for the standard `json` module, which reports
+payload sizes to ``flowser.metrics``.
 """
 import json
 
-dumps = json.dumps
-loads = json.loads
+from flowser import metrics
+
+
+def dumps(obj, **kwargs):
+    s = json.dumps(obj, **kwargs)
+    metrics.observe('payload.bytes', len(s), {'op': 'dumps'})
+    return s
+
+
+def loads(s, **kwargs):
+    metrics.observe('payload.bytes', len(s), {'op': 'loads'})
+    return json.loads(s, **kwargs)
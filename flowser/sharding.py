@@ -0,0 +1,78 @@
+# Copyright (c) 2012 Memoto AB
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""Sharding.
+
+A logical task list may be partitioned into a number of physical task lists
+(shards) named ``<task_list>-<n>``. Keys such as workflow ids are mapped to
+shards with a consistent hash ring, so that going from ``n`` to ``n + 1``
+shards only moves about ``1 / (n + 1)`` of the keys.
+
+Growing the number of shards is safe: workers poll every shard, including
+the old ones. Shrinking it strands tasks already scheduled on the removed
+shards until they time out, so drain those first.
+"""
+import bisect
+import hashlib
+
+_rings = {}
+
+
+def _hash(key):
+    if not isinstance(key, basestring):
+        key = str(key)
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return int(hashlib.md5(key).hexdigest()[:8], 16)
+
+
+def task_lists(task_list, shards):
+    """Names of the physical task lists of a logical one. """
+    if not shards:
+        return [task_list]
+    return ['%s-%d' % (task_list, n) for n in range(shards)]
+
+
+def route(task_list, shards, key):
+    """Physical task list for ``key``. """
+    if not shards:
+        return task_list
+    ring_key = (task_list, shards)
+    if ring_key not in _rings:
+        _rings[ring_key] = HashRing(task_lists(task_list, shards))
+    return _rings[ring_key].get(key)
+
+
+class HashRing(object):
+    """Consistent hash ring with ``replicas`` virtual points per node. """
+
+    def __init__(self, nodes, replicas=100):
+        points = []
+        for node in nodes:
+            for n in range(replicas):
+                points.append((_hash('%s#%d' % (node, n)), node))
+        points.sort()
+        self._hashes = [h for h, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def get(self, key):
+        idx = bisect.bisect(self._hashes, _hash(key))
+        return self._nodes[idx % len(self._nodes)]
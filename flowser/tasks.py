@@ -18,7 +18,10 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import time
+
 from boto.swf.layer1_decisions import Layer1Decisions
+from flowser import metrics
 from flowser import serializing
 from flowser.events import Event
 from flowser.exceptions import LastPage
@@ -30,6 +33,10 @@ class WorkflowExecution(object):
     See http://docs.amazonwebservices.com/amazonswf/latest/apireference/API_WorkflowExecution.html.
     """
 
+    # Start time, for executions listed by ``Workflow.iter_open`` or
+    # ``iter_closed``
+    start_timestamp = None
+
     def __init__(self, result, caller):
         self.run_id = result['runId']
         self.workflow_id = result['workflowId']
@@ -50,9 +57,29 @@ class WorkflowExecution(object):
         result = serializing.dumps(result)
         self._caller.decisions.complete_workflow_execution(result)
 
+    def history(self, reverse_order=False, page_size=None):
+        """Generate the history events of this execution.
+
+        Pages are fetched as the events are consumed.
+
+        :returns: Generator of ``events.Event`` instances.
+        """
+        next_page_token = None
+        while True:
+            page = self._domain.conn.get_workflow_execution_history(
+                    self._domain.name, self.run_id, self.workflow_id,
+                    maximum_page_size=page_size,
+                    next_page_token=next_page_token,
+                    reverse_order=reverse_order)
+            for result in page['events']:
+                yield Event(result)
+            next_page_token = page.get('nextPageToken')
+            if not next_page_token:
+                return
+
     def request_cancel(self):
-        self._domain.conn.request_cancel(self._domain.name, self.workflow_id, 
-                                         run_id=self.run_id)
+        self._domain.conn.request_cancel_workflow_execution(
+                self._domain.name, self.workflow_id, run_id=self.run_id)
 
     def signal(self, name, input=None):
         serialized_input = None
@@ -128,13 +155,26 @@ class Decision(object):
 
     This class assumes that history events are in reverse order (most recent
     first).
+
+    The task must be responded to within the ``task_start_to_close_timeout``
+    of the caller, counted from when this object is created. ``time_left``
+    and ``near_deadline`` tell how much of it remains.
     """
 
+    # Fraction of the task timeout kept in reserve by ``near_deadline``.
+    deadline_margin = 0.25
+
     def __init__(self, result, caller):
         """
         :param result: Result structure from the API. 
         :param caller: Caller object (subclass of ``types.Type``).
         """
+        self.polled_at = time.time()
+        try:
+            self.timeout = float(caller.task_start_to_close_timeout)
+        except (AttributeError, TypeError, ValueError):
+            # No timeout ('NONE')
+            self.timeout = None
         self.decisions = Layer1Decisions()
         self._caller = caller
         self._domain = caller._domain
@@ -156,6 +196,26 @@ class Decision(object):
     def _get_next_page_token(self, result):
         return result.get('nextPageToken', None)
 
+    def time_left(self):
+        """Seconds left until the task times out, or None. """
+        if self.timeout is None:
+            return None
+        return self.polled_at + self.timeout - time.time()
+
+    def near_deadline(self):
+        """Whether less than ``deadline_margin`` of the timeout is left. """
+        if self.timeout is None:
+            return False
+        return self.time_left() < self.timeout * self.deadline_margin
+
+    def retrigger(self):
+        """Adds a zero-length timer so that a new decision task follows
+        this one, e.g. to continue work cut short by ``near_deadline``. """
+        self.decisions.start_timer(
+                start_to_fire_timeout='0',
+                timer_id='flowser-retrigger-%s' % self.started_event_id)
+        return self
+
     @property
     def events(self):
         # First go through what we got. This list may have been extended
@@ -180,9 +240,12 @@ class Decision(object):
         """
         if self.next_page_token is None:
             raise LastPage
-        next_result = self._caller._poll_for_decision_task(
-                next_page_token=self.next_page_token,
-                reverse_order=True)
+        with metrics.timed('history.page_seconds'):
+            next_result = self._caller._poll_for_decision_task(
+                    next_page_token=self.next_page_token,
+                    reverse_order=True)
+        metrics.incr('history.pages')
+        metrics.incr('history.events', len(next_result['events']))
         self.next_page_token = self._get_next_page_token(next_result)
         self._events.extend(next_result['events'])
         return next_result['events']
@@ -219,10 +282,13 @@ class Decision(object):
         """Schedule activity. 
 
         Internally, this method calls the schedule classmethod on the 
-        activity type with the given args and kwargs.
+        activity type with the given args and kwargs. Sharded activity types
+        are routed by workflow id unless a ``shard_key`` is given.
 
         :param activity_type: Subclass of ``types.Activity``.
         """
+        if activity_type.shards and 'shard_key' not in kwargs:
+            kwargs['shard_key'] = self.workflow_execution.workflow_id
         dec = activity_type.schedule(*args, **kwargs)
         self.decisions._data.append(dec)
         return self
@@ -245,6 +311,7 @@ class Decision(object):
             execution_context = serializing.dumps(context)
 
         decisions = self.decisions._data
+        metrics.observe('decision.decisions', len(decisions))
         self._domain.conn.respond_decision_task_completed(
                 self.task_token, decisions=decisions,
                 execution_context=execution_context)
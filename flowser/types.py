@@ -18,12 +18,17 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import bisect
+import copy
 import time
 
 from boto.swf.exceptions import SWFTypeAlreadyExistsError
 from boto.swf.layer1_decisions import Layer1Decisions
 
 from flowser import serializing
+from flowser import sharding
+from flowser import tasks
+from flowser.concurrency import bounded_chain
 from flowser.exceptions import Error
 from flowser.exceptions import EmptyTaskPollResult
 
@@ -31,6 +36,15 @@ ONE_HOUR = 60 * 60
 ONE_DAY = ONE_HOUR * 24
 
 
+def _near(values, value, distance):
+    """Whether ``value`` is within ``distance`` of one of the sorted
+    ``values``. """
+    if value is None:
+        return False
+    i = bisect.bisect_left(values, value - distance)
+    return i < len(values) and values[i] <= value + distance
+
+
 def _raise_if_empty_poll_result(result):
     """Return result or raise ``EmptyTaskPollResult``. """
     if 'taskToken' not in result:
@@ -42,12 +56,26 @@ class Type(object):
     """Base class for Simple Workflow types (activities, workflows).
 
     Subclasses must set ``name``, ``version`` and ``task_list`` properties.
+    They may set ``shards`` to partition ``task_list`` into that many
+    physical task lists (see ``sharding``).
+
+    To be served by the ``flowser`` command (see ``worker``), a type
+    implements ``handle_task(self, task)``, which is called on an instance
+    with each polled ``tasks.Decision`` or ``tasks.Activity`` and must
+    respond to it (e.g. ``task.complete()``). Types without it are skipped.
     """
 
     # Override this in a subclass to the name (string) of a register method on
     # the connection object (as returned by boto.connect_swf).
     _reg_func_name = None
 
+    # Override these in a subclass to the name of a list method on the
+    # connection object and the type key of its "typeInfos" entries.
+    _list_func_name = None
+    _type_info_key = None
+
+    shards = None
+
     def __init__(self, domain):
         for needed_prop in ['name', 'task_list', 'version']:
             if not hasattr(self, needed_prop):
@@ -64,6 +92,44 @@ class Type(object):
             if raise_exists:
                 raise Error(self)
 
+    @classmethod
+    def _registered(cls, domain):
+        """Set of ``(name, version)`` of types of this kind registered in
+        ``domain``. """
+        assert cls._list_func_name is not None, "no list func configured"
+        list_func = getattr(domain.conn, cls._list_func_name)
+        registered = set()
+        next_page_token = None
+        while True:
+            page = list_func(domain.name, 'REGISTERED',
+                             next_page_token=next_page_token)
+            for info in page.get('typeInfos', []):
+                t = info[cls._type_info_key]
+                registered.add((t['name'], t['version']))
+            next_page_token = page.get('nextPageToken')
+            if not next_page_token:
+                return registered
+
+    @classmethod
+    def _route(cls, key):
+        """Task list to schedule on for ``key`` (sharded types). """
+        return sharding.route(cls.task_list, cls.shards, key)
+
+    def _shard_instances(self):
+        """One instance per physical task list.
+
+        Tasks polled through an instance keep using its task list, e.g. when
+        paginating decision task history.
+        """
+        if not self.shards:
+            return [self]
+        instances = []
+        for task_list in sharding.task_lists(self.task_list, self.shards):
+            instance = copy.copy(self)
+            instance.task_list = task_list
+            instances.append(instance)
+        return instances
+
     def _poll_for_activity_task(self, identity=None):
         """Low-level wrapper for boto's method with the same name. 
 
@@ -97,6 +163,8 @@ class Activity(Type):
     """
 
     _reg_func_name = 'register_activity_type'
+    _list_func_name = 'list_activity_types'
+    _type_info_key = 'activityType'
 
     heartbeat_timeout = str(ONE_HOUR)
     schedule_to_close_timeout = str(ONE_HOUR)
@@ -104,8 +172,14 @@ class Activity(Type):
     start_to_close_timeout = str(ONE_HOUR)
 
     @classmethod
-    def schedule(cls, activity_id, input, control=None):
-        "Called from subclasses' ``schedule`` class method. "
+    def schedule(cls, activity_id, input, control=None, shard_key=None):
+        """Called from subclasses' ``schedule`` class method.
+
+        For sharded types, the task list is picked by ``shard_key``, which
+        defaults to ``activity_id``.
+        """
+        if shard_key is None:
+            shard_key = activity_id
         if control is not None:
             control = serializing.dumps(control)
 
@@ -114,7 +188,7 @@ class Activity(Type):
             activity_id=activity_id,
             activity_type_name=cls.name,
             activity_type_version=cls.version,
-            task_list=cls.task_list,
+            task_list=cls._route(shard_key),
             control=control,
             heartbeat_timeout=cls.heartbeat_timeout,
             schedule_to_close_timeout=cls.schedule_to_close_timeout,
@@ -133,6 +207,8 @@ class Workflow(Type):
     """
 
     _reg_func_name = 'register_workflow_type'
+    _list_func_name = 'list_workflow_types'
+    _type_info_key = 'workflowType'
 
     # These may be overridden in subclasses.
     execution_start_to_close_timeout = '600'
@@ -179,20 +255,122 @@ class Workflow(Type):
                 workflow_name=self.name,
                 tag=self.default_filter_tag)
 
-    def _start(self, workflow_id, input):
+    def iter_open(self, latest_date=None, oldest_date=None, window=None,
+                  workers=4, page_size=None):
+        """Generate open executions of this type.
+
+        Every page of the listing is fetched lazily. If ``window`` (seconds)
+        is given, the range is split into windows of that length, which are
+        listed by ``workers`` threads in parallel; executions then come in
+        no particular order. An execution started on the boundary of two
+        windows is listed by both, but generated once.
+
+        :param latest_date: Newest start time (default: now).
+        :param oldest_date: Oldest start time (default: a day earlier).
+        :returns: Generator of ``tasks.WorkflowExecution`` instances.
+        """
+        if latest_date is None:
+            latest_date = time.time()
+        if oldest_date is None:
+            oldest_date = latest_date - ONE_DAY
+
+        def list_window(dates):
+            oldest, latest = dates
+            return self._iter_pages(
+                    self._conn.list_open_workflow_executions,
+                    latest_date=latest,
+                    oldest_date=oldest,
+                    maximum_page_size=page_size)
+
+        return self._iter_windows(list_window, oldest_date, latest_date,
+                                  window, workers)
+
+    def iter_closed(self, start_latest_date=None, start_oldest_date=None,
+                    window=None, workers=4, page_size=None):
+        """Generate closed executions of this type by start time.
+
+        See ``iter_open``.
+        """
+        if start_latest_date is None:
+            start_latest_date = time.time()
+        if start_oldest_date is None:
+            start_oldest_date = start_latest_date - ONE_DAY
+
+        def list_window(dates):
+            oldest, latest = dates
+            return self._iter_pages(
+                    self._conn.list_closed_workflow_executions,
+                    start_latest_date=latest,
+                    start_oldest_date=oldest,
+                    maximum_page_size=page_size)
+
+        return self._iter_windows(list_window, start_oldest_date,
+                                  start_latest_date, window, workers)
+
+    def _iter_pages(self, list_func, **kwargs):
+        next_page_token = None
+        while True:
+            page = list_func(self._domain.name,
+                             workflow_name=self.name,
+                             tag=self.default_filter_tag,
+                             next_page_token=next_page_token,
+                             **kwargs)
+            for info in page.get('executionInfos', []):
+                execution = tasks.WorkflowExecution(info['execution'], self)
+                execution.start_timestamp = info.get('startTimestamp')
+                yield execution
+            next_page_token = page.get('nextPageToken')
+            if not next_page_token:
+                return
+
+    def _iter_windows(self, list_window, oldest, latest, window, workers):
+        if window is None or latest - oldest <= window:
+            for execution in list_window((oldest, latest)):
+                yield execution
+            return
+        windows = []
+        while latest > oldest:
+            windows.append((max(latest - window, oldest), latest))
+            latest -= window
+        # Date filters include both ends, so adjacent windows both list
+        # executions started on their shared boundary. Only those (within a
+        # second, for rounding) are remembered, to generate them once.
+        boundaries = sorted(w[0] for w in windows[:-1])
+        seen = set()
+        for _, execution, error in bounded_chain(list_window, windows, workers):
+            if error is not None:
+                raise error
+            if _near(boundaries, execution.start_timestamp, 1):
+                key = (execution.workflow_id, execution.run_id)
+                if key in seen:
+                    continue
+                seen.add(key)
+            yield execution
+
+    def _start_template(self):
+        """Arguments to ``start_workflow_execution`` that are the same for
+        every execution of this type. """
+        return {
+            'domain': self._domain.name,
+            'workflow_name': self.name,
+            'workflow_version': self.version,
+            'task_list': self.task_list,
+            'child_policy': self.child_policy,
+            'execution_start_to_close_timeout':
+                self.execution_start_to_close_timeout,
+            'tag_list': self.default_tag_list, # XXX: name missmatch
+            'task_start_to_close_timeout': self.task_start_to_close_timeout,
+        }
+
+    def _start(self, workflow_id, input, template=None):
         """Start workflow execution"""
+        kwargs = template or self._start_template()
+        if self.shards:
+            kwargs = dict(kwargs, task_list=self._route(workflow_id))
         return self._conn.start_workflow_execution(
-            domain=self._domain.name,
             workflow_id=workflow_id,
-            workflow_name=self.name,
-            workflow_version=self.version,
-            task_list=self.task_list,
-            child_policy=self.child_policy,
-            execution_start_to_close_timeout=self.execution_start_to_close_timeout,
-            input=serializing.dumps(input), 
-            tag_list=self.default_tag_list, # XXX: name missmatch
-            task_start_to_close_timeout=self.task_start_to_close_timeout,
-        )
+            input=serializing.dumps(input),
+            **kwargs)
 
     @classmethod
     def start_child(cls, workflow_id, input, control=None):
@@ -208,8 +386,8 @@ class Workflow(Type):
             control=control,
             execution_start_to_close_timeout=cls.execution_start_to_close_timeout,
             input=serializing.dumps(input),
-            tag_list=cls.tag_list,
-            task_list=cls.task_list,
+            tag_list=cls.default_tag_list,
+            task_list=cls._route(workflow_id),
             task_start_to_close_timeout=cls.task_start_to_close_timeout,
         )
         # Unreleased bugfix in boto
@@ -0,0 +1,280 @@
+# Copyright (c) 2012 Memoto AB
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""Worker processes.
+
+The ``flowser`` console script forks worker processes for the types of a
+``Domain`` subclass and supervises them::
+
+    $ flowser myapp.swf.MyDomain --processes 4
+
+Every workflow and activity type of the domain that implements a
+``handle_task(task)`` method (see ``types.Type``) is served by
+``--processes`` children, each with a connection of its own. Crashed
+children are restarted. On SIGTERM (or SIGINT) the children stop polling,
+finish the task at hand and exit.
+"""
+import argparse
+import errno
+import logging
+import os
+import signal
+import sys
+import time
+
+from flowser import types
+from flowser.flow.utils import eval_clspath
+
+logger = logging.getLogger('flowser.worker')
+
+
+class Supervisor(object):
+    """Forks and supervises worker processes. """
+
+    # Children living shorter than this (seconds) are considered to crash
+    # on startup and are restarted with an increasing delay.
+    min_uptime = 5
+    max_restart_delay = 30
+
+    def __init__(self, domain_cls, conn_factory, processes=1, type_names=None,
+                 max_pollers=1, drain_timeout=None):
+        """
+        :param domain_cls: Subclass of ``domain.Domain``.
+        :param conn_factory: Callable returning a new connection.
+        :param processes: Number of processes per type.
+        :param type_names: Only serve types with these names (optional).
+        :param max_pollers: Passed to ``Domain.decisions``/``activities``.
+        :param drain_timeout: Seconds to wait for children on shutdown before
+                              killing them (default: wait forever).
+        """
+        self.domain_cls = domain_cls
+        self.conn_factory = conn_factory
+        self.processes = processes
+        self.type_names = type_names
+        self.max_pollers = max_pollers
+        self.drain_timeout = drain_timeout
+        self._children = {}
+        self._stopping = None
+        self._pid = None
+
+    def served_types(self):
+        """Types of the domain implementing ``handle_task``. """
+        domain_types = ((self.domain_cls.workflow_types or []) +
+                        (self.domain_cls.activity_types or []))
+        served = []
+        for t in domain_types:
+            if self.type_names and t.name not in self.type_names:
+                continue
+            if not hasattr(t, 'handle_task'):
+                logger.warning("%s has no handle_task, skipping", t.name)
+                continue
+            served.append(t)
+        return served
+
+    def run(self):
+        """Fork the children and supervise them until they have all exited
+        after a SIGTERM or SIGINT. """
+        specs = [(t, n) for t in self.served_types()
+                 for n in range(self.processes)]
+        if not specs:
+            logger.error("nothing to serve")
+            return 1
+        self._pid = os.getpid()
+        handlers = (signal.signal(signal.SIGTERM, self._on_signal),
+                    signal.signal(signal.SIGINT, self._on_signal))
+        try:
+            self._supervise(specs)
+        finally:
+            signal.signal(signal.SIGTERM, handlers[0])
+            signal.signal(signal.SIGINT, handlers[1])
+        return 0
+
+    def _supervise(self, specs):
+        delays = {}
+        for spec in specs:
+            self._spawn(spec)
+        while self._children:
+            pid, status = self._wait()
+            if pid is None:
+                self._check_drain_timeout()
+                continue
+            spec, started = self._children.pop(pid)
+            if self._stopping is not None:
+                continue
+            logger.warning("%s worker %d (pid %d) %s",
+                           spec[0].name, spec[1], pid, _describe(status))
+            time.sleep(self._restart_delay(delays, spec,
+                                           time.time() - started))
+            if self._stopping is None:
+                self._spawn(spec)
+
+    def _restart_delay(self, delays, spec, uptime):
+        """Seconds to wait before restarting a child that lived ``uptime``
+        seconds. ``delays`` holds the last delay of children crashing on
+        startup. """
+        if uptime >= self.min_uptime:
+            delays.pop(spec, None)
+            return 0
+        delay = delays[spec] = min(delays.get(spec, 0.5) * 2,
+                                   self.max_restart_delay)
+        return delay
+
+    def _wait(self):
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except OSError as e:
+            if e.errno in (errno.EINTR, errno.ECHILD):
+                return None, None
+            raise
+        if pid == 0:
+            time.sleep(0.2)
+            return None, None
+        return pid, status
+
+    def _check_drain_timeout(self):
+        if self._stopping is None or self.drain_timeout is None:
+            return
+        if time.time() - self._stopping < self.drain_timeout:
+            return
+        for pid in self._children:
+            logger.warning("killing worker pid %d", pid)
+            _kill(pid, signal.SIGKILL)
+
+    def _on_signal(self, signum, frame):
+        if os.getpid() != self._pid:
+            # A child that has not installed its own handlers yet; it has
+            # no task to finish.
+            raise SystemExit(0)
+        if self._stopping is None:
+            logger.info("draining %d workers", len(self._children))
+            self._stopping = time.time()
+        for pid in self._children:
+            _kill(pid, signal.SIGTERM)
+
+    def _spawn(self, spec):
+        pid = os.fork()
+        if pid:
+            self._children[pid] = (spec, time.time())
+            if self._stopping is not None:
+                # Signaled while forking, before the child was known
+                _kill(pid, signal.SIGTERM)
+            return
+        self._children = {}
+        code = 0
+        try:
+            _Worker(self.domain_cls(self.conn_factory()), spec[0],
+                    self.max_pollers).run()
+        except Exception:
+            logger.exception("%s worker %d crashed", spec[0].name, spec[1])
+            code = 1
+        finally:
+            logging.shutdown()
+            os._exit(code)
+
+
+class _Worker(object):
+    """Serves one type in a child process. """
+
+    def __init__(self, domain, t, max_pollers):
+        self.domain = domain
+        self.type = t
+        self.max_pollers = max_pollers
+        self.busy = False
+        self.draining = False
+
+    def run(self):
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, self._on_sigterm)
+        if issubclass(self.type, types.Workflow):
+            poll = self.domain.decisions
+        else:
+            poll = self.domain.activities
+        handler = self.type(self.domain)
+        for task in poll(self.type, max_pollers=self.max_pollers):
+            self.busy = True
+            try:
+                handler.handle_task(task)
+            finally:
+                self.busy = False
+            if self.draining:
+                break
+
+    def _on_sigterm(self, signum, frame):
+        # Between tasks there is nothing to finish; a task arriving from an
+        # interrupted poll is left to time out.
+        if not self.busy:
+            raise SystemExit(0)
+        self.draining = True
+
+
+def _describe(status):
+    """Describe a ``waitpid`` status. """
+    if os.WIFSIGNALED(status):
+        return "was killed by signal %d" % os.WTERMSIG(status)
+    return "exited with status %d" % os.WEXITSTATUS(status)
+
+
+def _kill(pid, signum):
+    try:
+        os.kill(pid, signum)
+    except OSError as e:
+        if e.errno != errno.ESRCH:
+            raise
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+            prog='flowser',
+            description='Run worker processes for a flowser domain.')
+    parser.add_argument('domain',
+            help='dotted path of a Domain subclass')
+    parser.add_argument('-p', '--processes', type=int, default=1,
+            help='processes per type (default: 1)')
+    parser.add_argument('-t', '--type', action='append', dest='type_names',
+            metavar='NAME', help='only serve this type (repeatable)')
+    parser.add_argument('--max-pollers', type=int, default=1,
+            help='concurrent long polls per process (default: 1)')
+    parser.add_argument('--connect', default='boto.connect_swf',
+            help='dotted path of a connection factory '
+                 '(default: boto.connect_swf)')
+    parser.add_argument('--register', action='store_true',
+            help='register the domain and its types first')
+    parser.add_argument('--drain-timeout', type=float, default=None,
+            help='seconds to wait for workers on shutdown')
+    parser.add_argument('--log-level', default='INFO')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(stream=sys.stderr, level=args.log_level.upper(),
+            format='%(asctime)s %(process)d %(name)s %(levelname)s %(message)s')
+    domain_cls = eval_clspath(args.domain)
+    conn_factory = eval_clspath(args.connect)
+    if args.register:
+        domain_cls(conn_factory()).register(raise_exists=False)
+    supervisor = Supervisor(domain_cls, conn_factory,
+                            processes=args.processes,
+                            type_names=args.type_names,
+                            max_pollers=args.max_pollers,
+                            drain_timeout=args.drain_timeout)
+    return supervisor.run()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -6,7 +6,10 @@ setup(name="flowser",
       author="Simon Pantzare",
       author_email="simon+flowser@pewpewlabs.com",
       url="https://github.com/pilt/flowser/",
-      packages=["flowser"],
+      packages=["flowser", "flowser.flow"],
+      entry_points={
+          "console_scripts": ["flowser = flowser.worker:main"],
+      },
       license="MIT",
       platforms="Posix; MacOS X; Windows",
       classifiers = [
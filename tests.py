@@ -27,16 +27,31 @@ Example run:
     $ FLOWSER_TEST_DOMAIN=flowser python tests.py
 
 """
+import json
 import os
+import signal
 import unittest
 from uuid import uuid4
 import threading
+import time
 import logging
+import subprocess
 import sys
+import tempfile
 
 import boto
+import boto.exception
 
 import flowser
+import flowser.analysis
+import flowser.bulk
+import flowser.flow
+import flowser.metrics
+import flowser.replay
+import flowser.worker
+from flowser.exceptions import EmptyTaskPollResult
+from flowser.polling import AdaptivePoller, Multiplexer, PollStats
+from flowser.sharding import HashRing
 
 TEST_DOMAIN = os.environ.get('FLOWSER_TEST_DOMAIN', None)
 if_environment = unittest.skipIf(not TEST_DOMAIN, 'FLOWSER_TEST_DOMAIN unset')
@@ -178,6 +193,1238 @@ class FlowserTestCase(unittest.TestCase):
         self.assertEqual(decider.result['sum_id'], 10)
 
 
+class PollStatsTestCase(unittest.TestCase):
+
+    def test_empty_ratio(self):
+        stats = PollStats(window=4)
+        for got_task in [True, False, False, False]:
+            stats.record(got_task)
+        self.assertTrue(stats.window_full)
+        self.assertEqual(stats.empty_ratio, 0.75)
+        self.assertEqual(stats.empty_polls, 3)
+
+    def test_arrival_rate(self):
+        stats = PollStats(window=4)
+        self.assertEqual(stats.arrival_rate, 0.0)
+        for _ in range(3):
+            stats.record(True)
+            time.sleep(0.05)
+        self.assertTrue(5 < stats.arrival_rate < 40, stats.arrival_rate)
+        stats.reset_window()
+        self.assertEqual(stats.arrival_rate, 0.0)
+
+
+class AdaptivePollerTestCase(unittest.TestCase):
+
+    def test_grows_when_busy(self):
+        poller = AdaptivePoller(lambda: {'taskToken': 'x'},
+                                min_pollers=1, max_pollers=3,
+                                stats=PollStats(window=2))
+        results = iter(poller)
+        for _ in range(50):
+            next(results)
+        self.assertEqual(poller.target, 3)
+        results.close()
+        poller.join()
+
+    def test_shrinks_when_idle(self):
+        polls = []
+
+        def poll():
+            polls.append(1)
+            if 20 < len(polls) < 60:
+                raise EmptyTaskPollResult
+            return {'taskToken': 'x'}
+
+        poller = AdaptivePoller(poll, min_pollers=1, max_pollers=3,
+                                stats=PollStats(window=2))
+        results = iter(poller)
+        for _ in range(20):
+            next(results)
+        # Waits through the empty polls
+        next(results)
+        self.assertEqual(poller.target, 1)
+        results.close()
+        poller.join()
+
+    def test_polls_only_for_waiting_consumers(self):
+        polls = []
+
+        def poll():
+            polls.append(1)
+            return {'taskToken': 'x'}
+
+        poller = AdaptivePoller(poll, min_pollers=3, max_pollers=3)
+        results = iter(poller)
+        next(results)
+        # Busy consumer: no poll is started for it
+        time.sleep(0.2)
+        self.assertEqual(len(polls), 1)
+        self.assertEqual(poller._results.qsize(), 0)
+        results.close()
+        poller.join()
+
+
+class FakeConn(object):
+    """Connection stub serving activity tasks from per-list queues. """
+
+    def __init__(self, activity_tasks=None):
+        self.activity_tasks = activity_tasks or {}
+        self.failed = []
+        self.started = {}
+        self.terminated = []
+        self.calls = []
+        self.histories = {}
+        self.lock = threading.Lock()
+
+    def poll_for_activity_task(self, domain, task_list, identity=None):
+        with self.lock:
+            pending = self.activity_tasks.get(task_list)
+            if not pending:
+                return {}
+            name = pending.pop(0)
+        return {
+            'activityId': name,
+            'activityType': {'name': name, 'version': '1.0.0'},
+            'input': '{}',
+            'startedEventId': 1,
+            'taskToken': 'token-%s' % name,
+            'workflowExecution': {'runId': 'r', 'workflowId': 'w'},
+        }
+
+    def start_workflow_execution(self, domain, workflow_id, **kwargs):
+        with self.lock:
+            if workflow_id in self.started:
+                raise boto.exception.SWFResponseError(400, 'Bad Request')
+            self.started[workflow_id] = kwargs
+        return {'runId': 'run-%s' % workflow_id}
+
+    def list_open_workflow_executions(self, domain, latest_date=None,
+                                      oldest_date=None, next_page_token=None,
+                                      **kwargs):
+        # One execution per second of start time, two per page.
+        start = int(next_page_token or oldest_date)
+        end = min(start + 2, int(latest_date))
+        page = {'executionInfos': [
+            {'execution': {'workflowId': str(n), 'runId': 'r'},
+             'startTimestamp': float(n)}
+            for n in range(start, end)]}
+        if end < latest_date:
+            page['nextPageToken'] = str(end)
+        return page
+
+    def terminate_workflow_execution(self, domain, workflow_id, **kwargs):
+        if workflow_id.startswith('closed'):
+            raise boto.exception.SWFResponseError(400, 'Bad Request')
+        with self.lock:
+            self.terminated.append(workflow_id)
+
+    def register_domain(self, name, retention_period):
+        self.calls.append('register_domain')
+
+    def list_activity_types(self, domain, registration_status,
+                            next_page_token=None):
+        self.calls.append('list_activity_types')
+        return {'typeInfos': [
+            {'activityType': {'name': 'SumActivity', 'version': '1.0.0'}}]}
+
+    def list_workflow_types(self, domain, registration_status,
+                            next_page_token=None):
+        self.calls.append('list_workflow_types')
+        return {}
+
+    def register_activity_type(self, domain, name, version):
+        self.calls.append(name)
+
+    def register_workflow_type(self, domain, name, version):
+        self.calls.append(name)
+
+    def respond_activity_task_failed(self, task_token, details=None,
+                                     reason=None):
+        self.failed.append((task_token, reason))
+
+    def respond_decision_task_completed(self, task_token, decisions=None,
+                                        execution_context=None):
+        self.calls.append('respond_decision_task_completed')
+
+    def get_workflow_execution_history(self, domain, run_id, workflow_id,
+                                       maximum_page_size=None,
+                                       next_page_token=None,
+                                       reverse_order=None):
+        # Two events per page.
+        start = int(next_page_token or 0)
+        events = self.histories[workflow_id]
+        page = {'events': events[start:start + 2]}
+        if start + 2 < len(events):
+            page['nextPageToken'] = str(start + 2)
+        return page
+
+
+class OfflineDomain(flowser.Domain):
+    name = 'offline'
+
+
+class MultiplexerTestCase(unittest.TestCase):
+
+    def test_dispatch_by_activity_type(self):
+        class SharedActivity(flowser.types.Activity):
+            name = 'SharedActivity'
+            version = '1.0.0'
+            task_list = 'Sum'
+
+        conn = FakeConn({
+            'Sum': ['Unknown', 'SumActivity', 'SharedActivity'],
+            'Multiply': ['MultiplyActivity'],
+        })
+        handled = []
+        mux = Multiplexer(OfflineDomain(conn))
+
+        def handle(task):
+            handled.append(task.activity_type.name)
+            if len(handled) == 3:
+                mux.stop()
+
+        mux.register(SumActivity, handle, weight=2)
+        mux.register(SharedActivity, handle)
+        mux.register(MultiplyActivity, handle)
+        mux.serve()
+        self.assertEqual(sorted(handled),
+                         ['MultiplyActivity', 'SharedActivity', 'SumActivity'])
+        self.assertEqual(conn.failed, [('token-Unknown', 'no handler for Unknown')])
+
+    def test_unknown_decision_type(self):
+        class DecisionConn(FakeConn):
+            # Like boto, there is no respond_decision_task_failed.
+            def __init__(self, names):
+                FakeConn.__init__(self)
+                self.names = names
+
+            def poll_for_decision_task(self, domain, task_list, *args):
+                if not self.names:
+                    return {}
+                name = self.names.pop(0)
+                return {
+                    'events': [], 'previousStartedEventId': 0,
+                    'startedEventId': 1, 'taskToken': 'token-' + name,
+                    'workflowExecution': {'workflowId': 'w', 'runId': 'r'},
+                    'workflowType': {'name': name, 'version': '1.0'},
+                }
+
+        conn = DecisionConn(['Unknown', 'ArithmeticWorkflow'])
+        handled = []
+        mux = Multiplexer(OfflineDomain(conn))
+
+        def handle(task):
+            handled.append(task.task_token)
+            mux.stop()
+
+        mux.register(ArithmeticWorkflow, handle)
+        logging.disable(logging.ERROR)
+        self.addCleanup(logging.disable, logging.NOTSET)
+        mux.serve()
+        self.assertEqual(handled, ['token-ArithmeticWorkflow'])
+
+
+class RecordingSink(flowser.metrics.Sink):
+
+    def __init__(self):
+        self.counters = {}
+        self.observed = []
+
+    def incr(self, name, value=1, tags=None):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, value, tags=None):
+        self.observed.append((name, tags))
+
+
+class MetricsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.sink = RecordingSink()
+        self.previous = flowser.metrics.configure(self.sink)
+
+    def tearDown(self):
+        flowser.metrics.configure(self.previous)
+
+    def test_activity_polling(self):
+        conn = FakeConn({'Sum': ['SumActivity', 'SumActivity']})
+        tasks = OfflineDomain(conn).activities(SumActivity)
+        next(tasks)
+        next(tasks)
+        self.assertTrue(('poll.seconds', {'task_list': 'Sum'})
+                        in self.sink.observed)
+        self.assertTrue(('handler.seconds', {'type': 'SumActivity'})
+                        in self.sink.observed)
+        self.assertTrue(('payload.bytes', {'op': 'loads'})
+                        in self.sink.observed)
+
+    def test_concurrent_flushes(self):
+        path = os.path.join(tempfile.mkdtemp(), 'flowser.prom')
+        flowser.metrics.configure(
+                flowser.metrics.PrometheusTextFile(path, flush_interval=0))
+        errors = []
+
+        def record():
+            try:
+                for _ in range(500):
+                    flowser.metrics.incr('poll.empty')
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=record) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(os.listdir(os.path.dirname(path)), ['flowser.prom'])
+
+    def test_sink_errors_are_not_raised(self):
+        class BrokenSink(flowser.metrics.Sink):
+            def incr(self, name, value=1, tags=None):
+                raise OSError('broken')
+
+        flowser.metrics.configure(BrokenSink())
+        logging.disable(logging.ERROR)
+        self.addCleanup(logging.disable, logging.NOTSET)
+        flowser.metrics.incr('poll.empty')
+
+    def test_prometheus_text_file(self):
+        path = os.path.join(tempfile.mkdtemp(), 'flowser.prom')
+        sink = flowser.metrics.PrometheusTextFile(path)
+        sink.incr('poll.empty', tags={'task_list': 'Sum'})
+        sink.incr('poll.empty', tags={'task_list': 'Sum'})
+        sink.observe('poll.seconds', 0.5)
+        sink.observe('poll.seconds', 1.5)
+        sink.flush()
+        with open(path) as f:
+            self.assertEqual(f.read().splitlines(), [
+                'flowser_poll_empty_total{task_list="Sum"} 2',
+                'flowser_poll_seconds_count 2',
+                'flowser_poll_seconds_sum 2.0',
+            ])
+
+
+class HandledActivity(flowser.types.Activity):
+    """Crashes the first worker, then asks the supervisor to drain. """
+    name = 'HandledActivity'
+    version = '1.0.0'
+    task_list = 'Handled'
+    log_path = None
+
+    def handle_task(self, task):
+        with open(self.log_path) as f:
+            first = not f.read()
+        with open(self.log_path, 'a') as f:
+            f.write('start\n')
+        if first:
+            os._exit(3)
+        os.kill(os.getppid(), signal.SIGTERM)
+        time.sleep(0.5)
+        with open(self.log_path, 'a') as f:
+            f.write('done\n')
+        task.complete()
+
+
+class WorkerDomain(flowser.Domain):
+    name = 'worker'
+    workflow_types = [ArithmeticWorkflow]
+    activity_types = [SumActivity, HandledActivity]
+
+
+def worker_conn():
+    conn = FakeConn({'Handled': ['HandledActivity'] * 5})
+    conn.respond_activity_task_completed = lambda *args, **kwargs: None
+    return conn
+
+
+class WorkerTestCase(unittest.TestCase):
+
+    def test_served_types(self):
+        supervisor = flowser.worker.Supervisor(WorkerDomain, worker_conn)
+        self.assertEqual(supervisor.served_types(), [HandledActivity])
+        supervisor.type_names = ['SumActivity']
+        self.assertEqual(supervisor.served_types(), [])
+
+    def test_main_with_nothing_to_serve(self):
+        self.assertEqual(flowser.worker.main([
+            __name__ + '.WorkerDomain', '--type', 'SumActivity',
+            '--connect', __name__ + '.worker_conn', '--log-level', 'critical',
+        ]), 1)
+        self.assertRaises(SystemExit, flowser.worker.main,
+                          [__name__ + '.WorkerDomain', '--processes', 'x'])
+
+    def test_describe_status(self):
+        self.assertEqual(flowser.worker._describe(3 << 8),
+                         'exited with status 3')
+        self.assertEqual(flowser.worker._describe(signal.SIGKILL),
+                         'was killed by signal 9')
+
+    def test_restart_delay(self):
+        supervisor = flowser.worker.Supervisor(WorkerDomain, worker_conn)
+        delays = {}
+        spec = (HandledActivity, 0)
+        uptimes = [0, 0, 60, 0, 0, 0]
+        self.assertEqual([supervisor._restart_delay(delays, spec, uptime)
+                          for uptime in uptimes], [1, 2, 0, 1, 2, 4])
+
+    def test_restart_and_drain(self):
+        HandledActivity.log_path = tempfile.mktemp()
+        open(HandledActivity.log_path, 'w').close()
+        self.addCleanup(os.remove, HandledActivity.log_path)
+        supervisor = flowser.worker.Supervisor(WorkerDomain, worker_conn,
+                                               drain_timeout=10)
+        supervisor.min_uptime = 0
+        handler = signal.getsignal(signal.SIGTERM)
+        self.assertEqual(supervisor.run(), 0)
+        self.assertEqual(signal.getsignal(signal.SIGTERM), handler)
+        with open(HandledActivity.log_path) as f:
+            # Restarted after the crash, finished its task when drained
+            self.assertEqual(f.read().split(), ['start', 'start', 'done'])
+
+
+class ShardedActivity(flowser.types.Activity):
+    name = 'ShardedActivity'
+    version = '1.0.0'
+    task_list = 'Sharded'
+    shards = 4
+
+
+class ShardingTestCase(unittest.TestCase):
+
+    def test_resharding_moves_few_keys(self):
+        keys = [str(uuid4()) for _ in range(2000)]
+        before = HashRing(['l-%d' % n for n in range(4)])
+        after = HashRing(['l-%d' % n for n in range(5)])
+        moved = sum(1 for k in keys if before.get(k) != after.get(k))
+        self.assertTrue(moved < len(keys) * 0.35, moved)
+
+    def test_schedule_routes_to_shard(self):
+        dec = ShardedActivity.schedule('a-1', {}, shard_key='wf-1')
+        task_list = dec['scheduleActivityTaskDecisionAttributes']['taskList']
+        self.assertEqual(task_list['name'], ShardedActivity._route('wf-1'))
+        self.assertTrue(task_list['name'].startswith('Sharded-'))
+
+    def test_pollers_spread_over_shards(self):
+        conn = FakeConn(dict(('Sharded-%d' % n, ['ShardedActivity'])
+                             for n in range(4)))
+        activities = OfflineDomain(conn).activities(ShardedActivity)
+        polled = [next(activities)._caller.task_list for _ in range(4)]
+        self.assertEqual(sorted(polled), ['Sharded-%d' % n for n in range(4)])
+
+    def test_poll_stats_per_shard(self):
+        conn = FakeConn(dict(('Sharded-%d' % n, ['ShardedActivity'])
+                             for n in range(4)))
+        domain = OfflineDomain(conn)
+        activities = domain.activities(ShardedActivity)
+        for _ in range(4):
+            next(activities)
+        keys = [('activity', 'Sharded-%d' % n) for n in range(4)]
+        self.assertEqual(sorted(domain.poll_stats), keys)
+        mux = Multiplexer(domain).register(ShardedActivity, lambda task: None)
+        self.assertEqual(sorted(mux._lists), keys)
+        for key in keys:
+            self.assertTrue(mux._lists[key].stats is domain.poll_stats[key])
+            self.assertEqual(domain.poll_stats[key].polls, 1)
+
+
+class StartManyTestCase(unittest.TestCase):
+
+    def test_reports_errors_per_item(self):
+        conn = FakeConn()
+        domain = OfflineDomain(conn)
+        items = ((str(n % 50), {'n': n}) for n in range(60))
+        results = list(domain.start_many(ArithmeticWorkflow, items, workers=4))
+        self.assertEqual(len(results), 60)
+        errors = [r for r in results if r[2] is not None]
+        self.assertEqual(len(errors), 10)
+        self.assertEqual(len(conn.started), 50)
+        self.assertEqual(conn.started['7']['task_list'], 'mainTaskList')
+
+
+class ListingTestCase(unittest.TestCase):
+
+    def test_iter_open_pages(self):
+        workflow = ArithmeticWorkflow(OfflineDomain(FakeConn()))
+        ids = [e.workflow_id for e in workflow.iter_open(10, 0)]
+        self.assertEqual(ids, [str(n) for n in range(10)])
+
+    def test_iter_open_windows(self):
+        workflow = ArithmeticWorkflow(OfflineDomain(FakeConn()))
+        executions = workflow.iter_open(100, 0, window=7, workers=3)
+        ids = sorted(int(e.workflow_id) for e in executions)
+        self.assertEqual(ids, range(100))
+
+    def test_iter_open_window_boundaries(self):
+        class InclusiveConn(FakeConn):
+            # Lists start times up to and including latest_date, like SWF.
+            def list_open_workflow_executions(self, domain, latest_date=None,
+                                              **kwargs):
+                return FakeConn.list_open_workflow_executions(
+                        self, domain, latest_date=latest_date + 1, **kwargs)
+
+        workflow = ArithmeticWorkflow(OfflineDomain(InclusiveConn()))
+        executions = workflow.iter_open(20, 0, window=5, workers=3)
+        ids = sorted(int(e.workflow_id) for e in executions)
+        self.assertEqual(ids, range(21))
+
+    def test_near_window_boundary(self):
+        self.assertTrue(flowser.types._near([5.0, 10.0], 10.5, 1))
+        self.assertFalse(flowser.types._near([5.0, 10.0], 7.0, 1))
+        self.assertFalse(flowser.types._near([], 7.0, 1))
+        self.assertFalse(flowser.types._near([5.0], None, 1))
+
+
+class BulkTestCase(unittest.TestCase):
+
+    def test_terminate_all(self):
+        conn = FakeConn()
+        workflow = ArithmeticWorkflow(OfflineDomain(conn))
+        executions = [
+            flowser.tasks.WorkflowExecution(
+                {'workflowId': prefix + str(n), 'runId': 'r'}, workflow)
+            for n in range(20) for prefix in ('open', 'closed')]
+        reports = []
+        failures = flowser.bulk.terminate_all(
+                executions, reason='test', workers=4,
+                progress=lambda p: reports.append(p.done), progress_every=10)
+        self.assertEqual(len(conn.terminated), 20)
+        self.assertEqual(sorted(e.workflow_id for e, _ in failures),
+                         sorted('closed' + str(n) for n in range(20)))
+        self.assertEqual(reports, [10, 20, 30, 40, 40])
+
+
+def history_event(event_id, event_type, time_stamp, **attrs):
+    key = event_type[0].lower() + event_type[1:] + 'EventAttributes'
+    return {'eventId': event_id, 'eventType': event_type,
+            'eventTimestamp': time_stamp, key: attrs}
+
+
+class AnalysisTestCase(unittest.TestCase):
+
+    def history(self, offset):
+        activity = {'name': 'SumActivity', 'version': '1.0.0'}
+        return [
+            history_event(1, 'DecisionTaskScheduled', 0,
+                          taskList={'name': 'Arithmetic'}),
+            history_event(2, 'DecisionTaskStarted', 1 + offset,
+                          scheduledEventId=1),
+            history_event(3, 'DecisionTaskCompleted', 2 + offset,
+                          scheduledEventId=1, startedEventId=2),
+            history_event(4, 'ActivityTaskScheduled', 2 + offset,
+                          activityType=activity, activityId='a',
+                          taskList={'name': 'Sum'}),
+            history_event(5, 'ActivityTaskStarted', 12 + offset,
+                          scheduledEventId=4),
+            history_event(6, 'TimerStarted', 12 + offset, timerId='t',
+                          startToFireTimeout='5'),
+            history_event(7, 'ActivityTaskCompleted', 15 + offset,
+                          scheduledEventId=4, startedEventId=5, result='1'),
+            history_event(8, 'TimerFired', 18 + offset, timerId='t',
+                          startedEventId=6),
+        ]
+
+    def test_analyze(self):
+        conn = FakeConn()
+        workflow = ArithmeticWorkflow(OfflineDomain(conn))
+        executions = []
+        for n in range(3):
+            conn.histories[str(n)] = self.history(n)
+            executions.append(flowser.tasks.WorkflowExecution(
+                {'workflowId': str(n), 'runId': 'r'}, workflow))
+        self.assertEqual(len(list(executions[0].history())), 8)
+        analyzer = flowser.analysis.LatencyAnalyzer()
+        analyzer.analyze(executions, workers=2)
+        summary = analyzer.summary()
+        activity = summary['activity'][('SumActivity', 'Sum')]
+        self.assertEqual(activity['schedule_to_start']['p50'], 10)
+        self.assertEqual(activity['start_to_close']['max'], 3)
+        decision = summary['decision']['Arithmetic']
+        self.assertEqual(decision['schedule_to_start']['p50'], 2)
+        self.assertEqual(decision['schedule_to_start']['count'], 3)
+        self.assertEqual(summary['timer']['t']['lateness']['mean'], 1)
+        self.assertTrue('SumActivity/Sum' in analyzer.report())
+
+
+class ReplayTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mktemp(suffix='.jsonl.gz')
+        self.domain = TestDomain(FakeConn())
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def decision(self, workflow_id):
+        events = [
+            history_event(1, 'WorkflowExecutionStarted', 0, input='{}'),
+            history_event(2, 'DecisionTaskScheduled', 0,
+                          taskList={'name': 'mainTaskList'}),
+            history_event(3, 'DecisionTaskStarted', 1, scheduledEventId=2),
+            history_event(4, 'ActivityTaskCompleted', 2, scheduledEventId=9,
+                          startedEventId=10, result='"done"'),
+        ]
+        return flowser.tasks.Decision({
+            'events': events[::-1],
+            'previousStartedEventId': 0,
+            'startedEventId': 3,
+            'taskToken': 'token',
+            'workflowExecution': {'workflowId': workflow_id, 'runId': 'r'},
+            'workflowType': {'name': 'ArithmeticWorkflow', 'version': '1.0.0'},
+        }, ArithmeticWorkflow(self.domain))
+
+    def decide(self, task):
+        flow = flowser.flow.Flow()
+        flowser.flow.ActivityNode(flow, activity_type=__name__ + '.SumActivity')
+        flow.decide(task)
+
+    def test_record_and_replay(self):
+        recorder = flowser.replay.Recorder(self.path)
+        decisions = [self.decision(str(n)) for n in range(3)]
+        for task in recorder.wrap(iter(decisions)):
+            self.decide(task)
+        self.assertEqual(recorder.count, 3)
+        records = list(flowser.replay.read(self.path))
+        self.assertEqual(records[0]['result']['events'][0]['eventType'],
+                         'ActivityTaskCompleted')
+        self.assertEqual(records[0]['result']['events'][0][
+            'activityTaskCompletedEventAttributes']['result'], '"done"')
+
+        result = flowser.replay.replay(self.path, self.domain, self.decide)
+        self.assertEqual((result.tasks, result.decisions), (3, 3))
+        self.assertEqual(result.mismatches, [])
+
+        counter = []
+
+        def nondeterministic(task):
+            counter.append(1)
+            task.mark('count', str(len(counter)))
+
+        result = flowser.replay.replay(self.path, self.domain,
+                                       nondeterministic, passes=2)
+        self.assertEqual(len(result.mismatches), 6)
+
+    def test_written_on_completion(self):
+        recorder = flowser.replay.Recorder(self.path)
+        for task in recorder.wrap(iter([self.decision('w')])):
+            self.decide(task)
+            task.complete()
+            self.assertEqual(recorder.count, 1)
+            self.assertEqual(len(list(flowser.replay.read(self.path))), 1)
+            break
+        self.assertEqual(recorder.count, 1)
+
+    def test_written_when_closed(self):
+        recorder = flowser.replay.Recorder(self.path)
+        tasks = recorder.wrap(iter([self.decision('a'), self.decision('b')]))
+        self.decide(next(tasks))
+        tasks.close()
+        records = list(flowser.replay.read(self.path))
+        self.assertEqual(len(records), 1)
+        self.assertEqual(len(records[0]['decisions']), 1)
+
+    def test_truncated_recording(self):
+        recorder = flowser.replay.Recorder(self.path)
+        tasks = iter([self.decision('a'), self.decision('b')])
+        for task in recorder.wrap(tasks):
+            self.decide(task)
+        with open(self.path, 'rb+') as f:
+            f.truncate(os.path.getsize(self.path) - 20)
+        records = list(flowser.replay.read(self.path))
+        self.assertEqual([r['result']['workflowExecution']['workflowId']
+                          for r in records], ['a'])
+
+    def test_replay_does_not_respond(self):
+        recorder = flowser.replay.Recorder(self.path)
+        for task in recorder.wrap(iter([self.decision('w')])):
+            self.decide(task)
+            task.complete()
+        conn = self.domain.conn
+        self.assertEqual(conn.calls, ['respond_decision_task_completed'])
+
+        def decide(task):
+            self.decide(task)
+            task.complete()
+
+        result = flowser.replay.replay(self.path, self.domain, decide)
+        self.assertEqual((result.tasks, result.errors), (1, []))
+        self.assertEqual(conn.calls, ['respond_decision_task_completed'])
+        self.assertTrue(self.domain.conn is conn)
+
+
+class RegistrationTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_path = tempfile.mktemp()
+
+    def tearDown(self):
+        if os.path.exists(self.cache_path):
+            os.remove(self.cache_path)
+
+    def test_registers_missing_types_once(self):
+        class CachedDomain(TestDomain):
+            name = 'offline'
+            registration_cache = self.cache_path
+
+        conn = FakeConn()
+        CachedDomain(conn).register()
+        self.assertEqual(sorted(conn.calls), [
+            'ArithmeticWorkflow', 'MultiplyActivity', 'list_activity_types',
+            'list_workflow_types', 'register_domain'])
+        conn.calls = []
+        CachedDomain(conn).register()
+        self.assertEqual(conn.calls, [])
+
+
+class LazyImportTestCase(unittest.TestCase):
+
+    def test_flow_does_not_import_boto(self):
+        out = subprocess.check_output([
+            sys.executable, '-c',
+            'import sys, flowser, flowser.flow; print("boto" in sys.modules)'],
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(out.strip(), 'False')
+
+
+def build_flow(width=3):
+    flow = flowser.flow.Flow(props={'width': width})
+    root = flowser.flow.Node(flow)
+    sink = flowser.flow.Node(flow)
+    for _ in range(width):
+        root.connect(flowser.flow.TimerNode(flow, timer_id='t')).connect(sink)
+    return flow
+
+
+def normalized(state):
+    """Frozen state with node records keyed by id and sorted edges. """
+    nodes = {}
+    for nodestate in state['nodes']:
+        nodestate = dict(nodestate)
+        nodestate['cls'] = state['classes'][nodestate['cls']]
+        nodestate['inputs'] = sorted(nodestate['inputs'])
+        nodestate['outputs'] = sorted(nodestate['outputs'])
+        nodes[nodestate['id']] = nodestate
+    return dict(state, nodes=nodes, classes=None, plan=None)
+
+
+class FreezeTestCase(unittest.TestCase):
+
+    def test_roundtrip(self):
+        flow = build_flow()
+        state = json.loads(json.dumps(flowser.flow.freeze(flow)))
+        self.assertEqual(len(state['classes']), 2)
+        copy = flowser.flow.unfreeze(state)
+        self.assertEqual(normalized(flowser.flow.freeze(copy)),
+                         normalized(state))
+
+    def test_unfreeze_class_paths(self):
+        state = flowser.flow.freeze(build_flow())
+        for nodestate in state['nodes']:
+            nodestate['cls'] = state['classes'][nodestate['cls']]
+        del state['classes']
+        copy = flowser.flow.unfreeze(state)
+        self.assertEqual(sorted(copy.nodes), sorted(build_flow().nodes))
+
+    def test_copy(self):
+        flow = build_flow()
+        flow.nodes['timernode-3'].ctx['fired'] = 1
+        clone = flow.copy()
+        self.assertEqual(normalized(flowser.flow.freeze(clone)),
+                         normalized(flowser.flow.freeze(flow)))
+        clone.nodes['timernode-3'].ctx['fired'] = 2
+        self.assertEqual(flow.nodes['timernode-3'].ctx['fired'], 1)
+        self.assertEqual(
+                set(n.id for n in clone.nodes['node-1'].outputs),
+                set(['timernode-3', 'timernode-4', 'timernode-5']))
+
+
+class PlanTestCase(unittest.TestCase):
+
+    def test_plan_is_cached_and_ordered(self):
+        state = flowser.flow.freeze(build_flow())
+        flow = flowser.flow.unfreeze(state)
+        plan = flow._plan
+        self.assertEqual(plan.ids[0], 'node-1')
+        self.assertEqual(plan.ids[-1], 'node-2')
+        self.assertEqual(list(plan.indegree), [0, 1, 1, 1, 3])
+        again = flowser.flow.unfreeze(flowser.flow.freeze(flow))
+        self.assertTrue(again._plan is plan)
+        self.assertEqual(normalized(flowser.flow.freeze(again)),
+                         normalized(state))
+
+    def test_cache_is_bounded(self):
+        from flowser.flow import plan
+        for width in range(1, plan.MAX_PLANS + 10):
+            state = flowser.flow.freeze(build_flow(width))
+            flow = flowser.flow.unfreeze(state)
+        self.assertEqual(len(plan._plans), plan.MAX_PLANS)
+        # The most recent shape is still cached
+        self.assertTrue((state['cls'], flow._plan.digest) in plan._plans)
+
+    def test_non_ascii_ids(self):
+        flow = flowser.flow.Flow()
+        flowser.flow.Node(flow, id=u'n\xf6de').connect(flowser.flow.Node(flow))
+        state = json.loads(json.dumps(flowser.flow.freeze(flow)))
+        self.assertEqual(flowser.flow.unfreeze(state)._plan.ids[0], u'n\xf6de')
+
+    def test_cycle(self):
+        flow = build_flow()
+        flow.nodes['node-2'].connect(flow.nodes['node-1'])
+        self.assertRaises(flowser.flow.CycleError, flowser.flow.unfreeze,
+                          flowser.flow.freeze(flow))
+
+
+class FakeEvent(object):
+
+    def __init__(self, id, type, **attrs):
+        self.id = id
+        self.type = type
+        self.attrs = attrs
+
+
+class FakeDecisions(object):
+
+    def __init__(self):
+        self._data = []
+        self.timers = []
+
+    def start_timer(self, start_to_fire_timeout, timer_id, control=None):
+        self.timers.append(timer_id)
+        self._data.append({'decisionType': 'StartTimer'})
+
+
+class FakeDecisionTask(object):
+    """Decision task stub recording scheduled activities. """
+
+    def __init__(self, events, previous_started_event_id):
+        self.events = events
+        self.previous_started_event_id = previous_started_event_id
+        self.started_event_id = events[0].id if events else 0
+        self.scheduled = []
+        self.markers = []
+        self.completed = []
+        self.decisions = FakeDecisions()
+        self.workflow_execution = type(
+                'Execution', (), {'complete': self.completed.append,
+                                  'workflow_id': 'parent'})
+
+    def schedule(self, activity_type, activity_id, input, control=None):
+        self.scheduled.append((activity_id, input))
+        self.decisions._data.append({'decisionType': 'ScheduleActivityTask'})
+
+    def start_child(self, workflow_type, workflow_id, input, control=None):
+        self.scheduled.append((workflow_id, input))
+        self.decisions._data.append(
+                {'decisionType': 'StartChildWorkflowExecution'})
+
+    def mark(self, name, details=None):
+        self.markers.append((name, details))
+        self.decisions._data.append({'decisionType': 'RecordMarker'})
+
+    def filter(self, event_type):
+        return [e for e in self.events if e.type == event_type]
+
+
+def run_flow(flow, work, max_rounds=10):
+    """Decide ``flow`` until done, completing every scheduled activity
+    with ``work(input)`` between decisions. Returns the scheduled inputs
+    per decision. """
+    history = []
+    previous = 0
+    rounds = []
+    for _ in range(max_rounds):
+        task = FakeDecisionTask(history[::-1], previous)
+        flow.decide(task)
+        rounds.append([input for _, input in task.scheduled])
+        if not task.scheduled:
+            return rounds
+        previous = len(history)
+        for activity_id, input in task.scheduled:
+            scheduled = FakeEvent(len(history) + 1, 'ActivityTaskScheduled',
+                                  activityId=activity_id)
+            completed = FakeEvent(len(history) + 2, 'ActivityTaskCompleted',
+                                  scheduledEventId=scheduled.id,
+                                  result=work(input))
+            history.extend([scheduled, completed])
+    return rounds
+
+
+class MapReduceTestCase(unittest.TestCase):
+
+    def source(self, flow, items):
+        node = flowser.flow.Node(flow)
+        node.result = items
+        return node
+
+    def test_map_batches(self):
+        flow = flowser.flow.Flow()
+        mapper = self.source(flow, range(10)).connect(flowser.flow.MapNode(
+                flow, activity_type=__name__ + '.SumActivity', batch_size=4))
+        rounds = run_flow(flow, lambda batch: [x * 2 for x in batch])
+        self.assertEqual(sorted(rounds[0]), [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]])
+        self.assertEqual(mapper.result, [x * 2 for x in range(10)])
+        self.assertEqual(mapper.status, flowser.flow.SUCCEED)
+
+    def test_map_input_order(self):
+        flow = flowser.flow.Flow()
+        sources = [self.source(flow, [n] * 2) for n in range(6)]
+        mapper = flowser.flow.MapNode(
+                flow, activity_type=__name__ + '.SumActivity', batch_size=5)
+        for source in sources:
+            source.connect(mapper)
+        rounds = run_flow(flow, lambda batch: batch)
+        expected = []
+        for source in sorted(sources, key=lambda s: s.id):
+            expected.extend(source.result)
+        self.assertEqual(rounds[0], [expected[i:i + 5]
+                                     for i in range(0, len(expected), 5)])
+        self.assertEqual(mapper.result, expected)
+
+    def test_map_payload_limit(self):
+        flow = flowser.flow.Flow()
+        self.source(flow, ['x' * 10] * 6).connect(flowser.flow.MapNode(
+                flow, activity_type=__name__ + '.SumActivity',
+                max_input_size=30))
+        rounds = run_flow(flow, lambda batch: batch)
+        self.assertEqual(len(rounds[0]), 3)
+
+    def test_tree_reduce(self):
+        flow = flowser.flow.Flow()
+        reducer = self.source(flow, range(100)).connect(
+                flowser.flow.TreeReduceNode(
+                    flow, activity_type=__name__ + '.SumActivity', fan_in=5))
+        rounds = run_flow(flow, sum)
+        self.assertEqual([len(r) for r in rounds], [20, 4, 1, 0])
+        self.assertEqual(reducer.result, sum(range(100)))
+
+    def test_tree_reduce_must_reduce(self):
+        flow = flowser.flow.Flow()
+        reducer = self.source(flow, ['x' * 20] * 4).connect(
+                flowser.flow.TreeReduceNode(
+                    flow, activity_type=__name__ + '.SumActivity',
+                    max_input_size=40))
+        rounds = run_flow(flow, lambda batch: batch[0], max_rounds=8)
+        self.assertEqual([len(r) for r in rounds], [4, 0])
+        self.assertEqual(reducer.status, flowser.flow.FAILED)
+        self.assertTrue('does not reduce 4 values' in reducer.ctx['error'])
+
+    def test_item_over_input_size(self):
+        flow = flowser.flow.Flow()
+        mapper = self.source(flow, ['x' * 50, 'y']).connect(
+                flowser.flow.MapNode(
+                    flow, activity_type=__name__ + '.SumActivity',
+                    max_input_size=40))
+        rounds = run_flow(flow, lambda batch: batch)
+        self.assertEqual(rounds, [[]])
+        self.assertEqual(mapper.status, flowser.flow.FAILED)
+        self.assertTrue('over max_input_size (40)' in mapper.ctx['error'])
+
+
+class ChildWorkflowNodeTestCase(unittest.TestCase):
+
+    def test_shards_with_bounded_concurrency(self):
+        flow = flowser.flow.Flow()
+        source = flowser.flow.Node(flow)
+        source.result = range(10)
+        child = source.connect(flowser.flow.ChildWorkflowNode(
+                flow, workflow_type=__name__ + '.ArithmeticWorkflow',
+                shard_size=3, max_children=2))
+        history = []
+        started = []
+        previous = 0
+        for _ in range(10):
+            task = FakeDecisionTask(history[::-1], previous)
+            flow.decide(task)
+            if not task.scheduled:
+                break
+            started.append([wid for wid, _ in task.scheduled])
+            previous = len(history)
+            for workflow_id, input in task.scheduled:
+                history.append(FakeEvent(
+                        len(history) + 1, 'ChildWorkflowExecutionCompleted',
+                        workflowExecution={'workflowId': workflow_id},
+                        result=sum(input)))
+        self.assertEqual(started, [
+            ['parent-%s-0' % child.id, 'parent-%s-1' % child.id],
+            ['parent-%s-2' % child.id, 'parent-%s-3' % child.id]])
+        self.assertEqual(child.result, [3, 12, 21, 9])
+        self.assertEqual(child.status, flowser.flow.SUCCEED)
+
+    def test_input_size_limit(self):
+        flow = flowser.flow.Flow()
+        source = flowser.flow.Node(flow)
+        source.result = ['x' * 10000] * 10
+        source.connect(flowser.flow.ChildWorkflowNode(
+                flow, workflow_type=__name__ + '.ArithmeticWorkflow',
+                max_children=100))
+        task = FakeDecisionTask([], 0)
+        flow.decide(task)
+        inputs = [input for _, input in task.scheduled]
+        self.assertEqual([len(i) for i in inputs], [3, 3, 3, 1])
+        for input in inputs:
+            self.assertTrue(len(json.dumps(input)) <= 32768)
+
+
+@flowser.flow.local_activity
+def double_all(inputs):
+    return [x * 2 for x in inputs[0]]
+
+
+@flowser.flow.local_activity(name='repeat')
+def repeat_all(inputs):
+    return inputs[0] * 20000
+
+
+class LocalActivityNodeTestCase(unittest.TestCase):
+
+    def build(self, function='double_all'):
+        flow = flowser.flow.Flow()
+        source = flowser.flow.Node(flow)
+        source.result = [1, 2]
+        node = source.connect(flowser.flow.LocalActivityNode(
+                flow, function=function))
+        return flow, node
+
+    def test_runs_in_decider(self):
+        flow, node = self.build()
+        task = FakeDecisionTask([], 0)
+        flow.decide(task)
+        self.assertEqual(node.result, [2, 4])
+        self.assertEqual(task.markers, [(node.marker_name, '{"result": [2, 4]}')])
+        self.assertEqual(task.completed, ['UNKNOWN'])
+
+    def test_replays_marker(self):
+        flow, node = self.build()
+        task = FakeDecisionTask([FakeEvent(
+                1, 'MarkerRecorded', markerName=node.marker_name,
+                details='{"result": "recorded"}')], 0)
+        flow.decide(task)
+        self.assertEqual(node.result, 'recorded')
+        self.assertEqual(task.markers, [])
+
+    def test_unregistered_function(self):
+        flow, node = self.build('missing')
+        task = FakeDecisionTask([], 0)
+        flow.decide(task)
+        self.assertEqual(node.status, flowser.flow.FAILED)
+        self.assertEqual(node.ctx['error'],
+                         "no local activity registered as 'missing'")
+
+    def test_details_size_limit(self):
+        flow, node = self.build('repeat')
+        task = FakeDecisionTask([], 0)
+        flow.decide(task)
+        self.assertEqual(node.status, flowser.flow.FAILED)
+        self.assertTrue('over the 32768 bytes' in node.ctx['error'])
+        self.assertTrue(len(task.markers[0][1]) <= 32768)
+
+
+class ResultCacheTestCase(unittest.TestCase):
+
+    def run_memoized(self, cache):
+        flow = flowser.flow.Flow()
+        flow.result_cache = cache
+        source = flowser.flow.Node(flow)
+        source.result = range(10)
+        node = source.connect(flowser.flow.TreeReduceNode(
+                flow, activity_type=__name__ + '.SumActivity', fan_in=3,
+                memoize=True))
+        rounds = run_flow(flow, sum)
+        self.assertEqual(node.result, 45)
+        return rounds
+
+    def test_memory_cache(self):
+        cache = flowser.flow.ResultCache()
+        self.assertEqual(len(self.run_memoized(cache)), 4)
+        self.assertEqual(self.run_memoized(cache), [[]])
+        self.assertEqual((cache.hits, cache.misses), (7, 7))
+
+    def test_sqlite_cache_ttl(self):
+        path = tempfile.mktemp()
+        try:
+            store = flowser.flow.SqliteResultStore(path)
+            cache = flowser.flow.ResultCache(store, ttl=60)
+            key = cache.key(SumActivity, [1, 2])
+            cache.store(key, 3)
+            self.assertEqual(cache.lookup(key), (True, 3))
+            cache.ttl = -1
+            cache.store(key, 3)
+            self.assertEqual(cache.lookup(key), (False, None))
+        finally:
+            os.remove(path)
+
+
+class DeadlineTestCase(unittest.TestCase):
+
+    def decision(self):
+        workflow = ArithmeticWorkflow(OfflineDomain(FakeConn()))
+        return flowser.tasks.Decision({
+            'events': [],
+            'previousStartedEventId': 0,
+            'startedEventId': 3,
+            'taskToken': 'token',
+            'workflowExecution': {'workflowId': 'w', 'runId': 'r'},
+            'workflowType': {'name': 'ArithmeticWorkflow', 'version': '1.0.0'},
+        }, workflow)
+
+    def test_time_left(self):
+        task = self.decision()
+        self.assertFalse(task.near_deadline())
+        task.polled_at -= 100
+        self.assertTrue(task.time_left() <= 20)
+        self.assertTrue(task.near_deadline())
+        task.retrigger()
+        attrs = task.decisions._data[0]['startTimerDecisionAttributes']
+        self.assertEqual(attrs['timerId'], 'flowser-retrigger-3')
+
+    def test_flow_yields_near_deadline(self):
+        flow = flowser.flow.Flow()
+        for n in range(3):
+            flowser.flow.ActivityNode(
+                    flow, activity_type=__name__ + '.SumActivity')
+        calls = []
+        task = FakeDecisionTask([], 0)
+        task.near_deadline = lambda: len(calls) > 1
+        task.retrigger = lambda: calls.append('retrigger')
+
+        def schedule(*args, **kwargs):
+            calls.append('schedule')
+            FakeDecisionTask.schedule(task, *args, **kwargs)
+
+        task.schedule = schedule
+        self.assertFalse(flow.decide(task))
+        self.assertEqual(calls, ['schedule', 'schedule', 'retrigger'])
+        self.assertEqual(task.completed, [])
+
+    def test_flow_decides_one_node_near_deadline(self):
+        flow = flowser.flow.Flow()
+        for n in range(3):
+            flowser.flow.ActivityNode(
+                    flow, activity_type=__name__ + '.SumActivity')
+        retriggers = []
+        task = FakeDecisionTask([], 0)
+        task.near_deadline = lambda: True
+        task.retrigger = lambda: retriggers.append(1)
+        self.assertFalse(flow.decide(task))
+        self.assertEqual(len(task.scheduled), 1)
+        self.assertEqual(retriggers, [1])
+
+
+class ProfilerTestCase(unittest.TestCase):
+
+    def test_node_spans(self):
+        flow = flowser.flow.Flow()
+        flow.profiler = flowser.flow.Profiler(trace_memory=True)
+        source = flowser.flow.Node(flow)
+        source.result = range(10)
+        mapper = source.connect(flowser.flow.MapNode(
+                flow, activity_type=__name__ + '.SumActivity', batch_size=4))
+        run_flow(flow, lambda batch: batch)
+        first, second = flow.profiler.decisions
+        self.assertEqual([(s['node'], s['decisions']) for s in first['nodes']],
+                         [(source.id, 0), (mapper.id, 3)])
+        self.assertEqual([s['events'] for s in second['nodes']], [6])
+        self.assertEqual([(t['node'], t['to']) for t in second['transitions']],
+                         [(mapper.id, 'SUCCEED')])
+        self.assertTrue(mapper.id in flow.profiler.report())
+        trace = json.loads(json.dumps(flow.profiler.chrome_trace()))
+        self.assertEqual(len([e for e in trace['traceEvents']
+                              if e['ph'] == 'X']), 5)
+
+
+class GovernorTestCase(unittest.TestCase):
+
+    def build(self, governor):
+        flow = flowser.flow.Flow()
+        flow.governor = governor
+        source = flowser.flow.Node(flow)
+        source.result = range(5)
+        node = source.connect(flowser.flow.MapNode(
+                flow, activity_type=__name__ + '.SumActivity', batch_size=1))
+        return flow, node
+
+    def test_limits_concurrency(self):
+        governor = flowser.flow.Governor({'SumActivity': 2})
+        flow, node = self.build(governor)
+        rounds = run_flow(flow, lambda batch: batch)
+        self.assertEqual([len(r) for r in rounds], [2, 2, 1, 0])
+        self.assertEqual(sorted(node.result), range(5))
+
+    def test_defers_with_timer(self):
+        path = tempfile.mktemp()
+        try:
+            store = flowser.flow.SqliteLeaseStore(path)
+            governor = flowser.flow.Governor({'SumActivity': 1}, store)
+            self.assertEqual(governor.acquire(SumActivity, ['a', 'b']), ['a'])
+            flow, node = self.build(governor)
+            task = FakeDecisionTask([], 0)
+            flow.decide(task)
+            self.assertEqual(task.scheduled, [])
+            self.assertEqual(task.decisions.timers, [node.id + '-retry-1'])
+            self.assertEqual(len(node.deferred), 5)
+            governor.release(SumActivity, ['a'])
+            task = FakeDecisionTask([FakeEvent(
+                    1, 'TimerFired', timerId=node.id + '-retry-1')], 0)
+            flow.decide(task)
+            self.assertEqual(len(task.scheduled), 1)
+            self.assertEqual(len(node.deferred), 4)
+        finally:
+            os.remove(path)
+
+    def test_released_when_scheduling_fails(self):
+        governor = flowser.flow.Governor({'SumActivity': 1})
+        flow, node = self.build(governor)
+        task = FakeDecisionTask([], 0)
+        flow.decide(task)
+        self.assertEqual(len(task.scheduled), 1)
+        task = FakeDecisionTask([FakeEvent(
+                1, 'ScheduleActivityTaskFailed', activityId=node.id + '-0',
+                cause='ACTIVITY_TYPE_DEPRECATED')], 0)
+        flow.decide(task)
+        self.assertEqual(node.failed.keys(), [node.id + '-0'])
+        self.assertEqual(len(task.scheduled), 1)
+
+    def test_lease_ttl_without_timeout(self):
+        class Unbounded(SumActivity):
+            schedule_to_close_timeout = 'NONE'
+        store = flowser.flow.MemoryLeaseStore()
+        governor = flowser.flow.Governor({'SumActivity': 1}, store)
+        self.assertEqual(governor.acquire(Unbounded, ['a']), ['a'])
+        expires = store._leases['SumActivity']['a'] - time.time()
+        self.assertAlmostEqual(expires, governor.default_lease_ttl, -1)
+
+
+class SnapshotTestCase(unittest.TestCase):
+
+    def test_delta_holds_changed_nodes(self):
+        flow = build_flow(width=10)
+        snapshots = flowser.flow.Snapshots()
+        records = [snapshots.save(flow)]
+        self.assertFalse(records[0]['delta'])
+        node = flow.nodes['timernode-3']
+        node.ctx['fired'] = 1
+        node.touch()
+        node.result = 'done'
+        records.append(snapshots.save(flow))
+        self.assertTrue(records[1]['delta'])
+        self.assertEqual([n['id'] for n in records[1]['nodes']],
+                         ['timernode-3'])
+        restored = flowser.flow.Snapshots.from_records(
+                json.loads(json.dumps(records))).load()
+        self.assertEqual(normalized(flowser.flow.freeze(restored)),
+                         normalized(flowser.flow.freeze(flow)))
+        self.assertEqual(restored.dirty, set())
+
+    def test_compaction(self):
+        flow = build_flow()
+        snapshots = flowser.flow.Snapshots(compact_every=3)
+        records = [snapshots.save(flow) for _ in range(4)]
+        self.assertEqual([r['delta'] for r in records],
+                         [False, True, True, False])
+
+
 if __name__ == '__main__':
     logging.basicConfig(stream=sys.stderr)
     logging.getLogger("flowsertest").setLevel(logging.DEBUG)